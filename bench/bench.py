@@ -0,0 +1,319 @@
+# Replays scripted scenarios against the bot, talking to a fake Bot API instead of Telegram:
+#   python bench/bench.py [scenario ...] [--scale N] [--json results.json] [--baseline previous.json]
+import os
+import sys
+import json
+import random
+import asyncio
+import argparse
+import threading
+import tempfile
+import importlib.util
+from time import monotonic
+from collections import Counter
+from fake_api import FakeBotApiProcess
+
+# The bot lives in a single script whose name isn't importable as is
+spec = importlib.util.spec_from_file_location("works_for_me", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "works-for-me.py"))
+wfm = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(wfm)
+
+TOKEN = "123456:bench"
+WORDS = ["dinner", "dungeons", "dragons", "drinks", "cinema", "concert", "climbing", "pizza", "picnic", "poker",
+    "board games", "bowling", "brunch", "karaoke", "kayak", "hiking", "holiday", "museum", "match", "meeting"]
+DAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+class UpdateFactory:
+    # Update ids are only given by number(), once a scenario decided the order updates arrive in, as Telegram hands them out in order
+    def __init__(self):
+        self.last_id = 0
+    def next_id(self):
+        self.last_id += 1
+        return self.last_id
+    @staticmethod
+    def user(userid):
+        return {"id": userid, "is_bot": False, "first_name": f"User {userid}", "username": f"user{userid}"}
+    def number(self, updates):
+        for update in updates:
+            update["update_id"] = self.next_id()
+        return updates
+    def message(self, userid, text):
+        message = {"message_id": self.next_id(), "date": 0, "chat": {"id": userid, "type": "private"}, "from": UpdateFactory.user(userid), "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": message}
+    def callback(self, userid, data, inline_message_id):
+        return {"callback_query": {"id": str(self.next_id()), "from": UpdateFactory.user(userid),
+            "chat_instance": "bench", "data": data, "inline_message_id": inline_message_id}}
+    def inline_query(self, userid, query):
+        return {"inline_query": {"id": str(self.next_id()), "from": UpdateFactory.user(userid), "query": query, "offset": ""}}
+
+class QueryCounter:
+    # Counts the statements every pooled connection runs, the trace callback is invoked from the repository threads
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+    def attach(self, pool):
+        open_connection = pool.open
+        def open():
+            conn = open_connection()
+            previous = [None]
+            def trace(statement):
+                # Python reports every trigger program starting with the text of the statement firing it,
+                # so on one connection the same text twice in a row is a trigger running
+                self.trace(statement, statement == previous[0])
+                previous[0] = statement
+            conn.set_trace_callback(trace)
+            return conn
+        pool.open = open
+    def trace(self, statement, nested = False):
+        # Statements run by triggers and by FTS5 on its shadow tables are counted apart, FTS5 reports its own as comments
+        kind = "NESTED" if nested or statement.startswith("--") else statement.lstrip().split(None, 1)[0].upper()
+        with self.lock:
+            self.counts[kind] += 1
+    def total(self):
+        with self.lock:
+            return sum(n for kind, n in self.counts.items() if kind != "NESTED")
+
+class Scenario:
+    name: str = None
+    def __init__(self, scale, rng: random.Random):
+        self.scale = scale
+        self.rng = rng
+    def setup(self, repo):
+        pass
+    def updates(self, factory: UpdateFactory):
+        return []
+
+class VoteStorm(Scenario):
+    # Many users hammering one plan with a lot of options, posted in several chats
+    name = "vote_storm"
+    def setup(self, repo):
+        self.planid = repo.start_plan_creation("Which day works for the raid?", 1)
+        for i in range(25):
+            repo.add_option(f"{DAYS[i % 7]} {i // 7 + 1}", self.planid)
+        repo.plan_ready(self.planid)
+        self.options = [o["rowid"] for o in repo.get_all_options(self.planid)]
+        self.messages = [f"IM{i}" for i in range(20)]
+        for inline_message_id in self.messages:
+            repo.add_posted_message(self.planid, inline_message_id)
+    def updates(self, factory):
+        return [factory.callback(self.rng.randrange(100, 100 + 20 * self.scale), f"v|{self.planid}|{self.rng.choice(self.options)}", self.rng.choice(self.messages))
+            for i in range(200 * self.scale)]
+
+class InlineTyping(Scenario):
+    # Users typing a search in inline mode, one inline query per keystroke
+    name = "inline_typing"
+    def setup(self, repo):
+        self.users = list(range(100, 100 + 10 * self.scale))
+        for userid in self.users:
+            for i in range(30):
+                planid = repo.start_plan_creation(f"{self.rng.choice(WORDS)} on {self.rng.choice(DAYS)} #{i}", userid)
+                repo.add_option("yes", planid)
+                repo.plan_ready(planid)
+    def updates(self, factory):
+        bursts = []
+        for userid in self.users:
+            for word in self.rng.sample(WORDS, 3):
+                bursts.append([factory.inline_query(userid, word[:n]) for n in range(1, len(word) + 1)])
+        # Keystrokes of different users interleave, each user's own keystrokes stay in order
+        updates = []
+        while bursts:
+            burst = self.rng.choice(bursts)
+            updates.append(burst.pop(0))
+            if not burst:
+                bursts.remove(burst)
+        return updates
+
+class MassCreation(Scenario):
+    # Many users creating plans at the same time through the private chat conversation
+    name = "mass_creation"
+    def updates(self, factory):
+        conversations = []
+        for userid in range(100, 100 + 20 * self.scale):
+            texts = ["/new", f"{self.rng.choice(WORDS)} this week?"] + self.rng.sample(DAYS, 4) + ["/done"]
+            conversations.append([factory.message(userid, text) for text in texts])
+        updates = []
+        while conversations:
+            conversation = self.rng.choice(conversations)
+            updates.append(conversation.pop(0))
+            if not conversation:
+                conversations.remove(conversation)
+        return updates
+
+class ImpatientClicks(Scenario):
+    # Users pressing the same button several times before the message changes, on votes and on refreshing the poll
+    name = "impatient_clicks"
+    def setup(self, repo):
+        self.planid = repo.start_plan_creation("Pizza tonight?", 1)
+        for day in DAYS[:5]:
+            repo.add_option(day, self.planid)
+        repo.plan_ready(self.planid)
+        self.options = [o["rowid"] for o in repo.get_all_options(self.planid)]
+        self.messages = [f"IM{i}" for i in range(10)]
+        for inline_message_id in self.messages:
+            repo.add_posted_message(self.planid, inline_message_id)
+    def updates(self, factory):
+        bursts = []
+        for userid in range(100, 100 + 40 * self.scale):
+            message = self.rng.choice(self.messages)
+            data = f"v|{self.planid}|{self.rng.choice(self.options)}" if self.rng.random() < 0.8 else f"sr|{self.planid}"
+            bursts.append([factory.callback(userid, data, message) for _ in range(self.rng.randint(1, 5))])
+        updates = []
+        while bursts:
+            burst = self.rng.choice(bursts)
+            updates.append(burst.pop(0))
+            if not burst:
+                bursts.remove(burst)
+        return updates
+
+SCENARIOS = {s.name: s for s in (VoteStorm, InlineTyping, MassCreation, ImpatientClicks)}
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))]
+
+async def run_scenario(scenario: Scenario, api: FakeBotApiProcess, factory: UpdateFactory, args, directory, run = 0):
+    dbname = os.path.join(directory, f"{scenario.name}-{run}.db")
+    setup_repo = wfm.Repository(dbname)
+    setup_repo.create_database()
+    scenario.setup(setup_repo)
+    setup_repo.close()
+    # A fresh repository for the run, so caches start cold and only the bot's own queries are counted
+    repo = wfm.Repository(dbname, pool_size=args.db_pool_size, synchronous=args.db_synchronous,
+        vote_buffer_delay=args.vote_buffer_ms / 1000 if args.vote_buffer_ms else None, vote_buffer_size=args.vote_buffer_size)
+    queries = QueryCounter()
+    queries.attach(repo.pool)
+    bot = wfm.Bot(TOKEN, wfm.AsyncRepository(repo), "WorksForMeBot", fanout_delay=args.fanout_delay, global_rate=args.global_rate,
+        chat_rate=args.chat_rate, chat_burst=args.chat_burst, base_url=api.base_url, concurrent_updates=args.concurrent_updates)
+    done = {}
+    handler_times = []
+    errors = []
+    # Handler time is how long the handlers ran, latency also counts the wait for a processing slot and for earlier updates with the same ordering key
+    processor = bot.app.update_processor
+    process = processor.do_process_update
+    async def timed(update, coroutine):
+        async def handler():
+            started = monotonic()
+            try:
+                await coroutine
+            finally:
+                handler_times.append(monotonic() - started)
+        try:
+            await process(update, handler())
+        finally:
+            done[update.update_id] = monotonic()
+    processor.do_process_update = timed
+    async def on_error(update, context):
+        errors.append(context.error)
+    bot.app.add_error_handler(on_error)
+    updates = factory.number(scenario.updates(factory))
+    await bot.app.initialize()
+    await bot.post_init(bot.app)
+    await bot.app.updater.start_polling(poll_interval=0.0, timeout=1)
+    await bot.app.start()
+    api.reset()
+    start_queries = queries.total()
+    api.push(*updates)
+    deadline = monotonic() + args.timeout
+    while len(done) < len(updates) and monotonic() < deadline:
+        await asyncio.sleep(0.005)
+    handled = monotonic()
+    # Fan-out edits and queued sends still belong to this scenario
+    while (bot.fanout_pending or not bot.outbound.queue.empty() or bot.outbound.running) and monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    await bot.app.updater.stop()
+    await bot.app.stop()
+    await bot.post_stop(bot.app)
+    await bot.app.shutdown()
+    await bot.post_shutdown(bot.app)
+    api_calls, delivered = api.stats()
+    latencies = [done[u] - delivered[u] for u in done if u in delivered]
+    first = min(delivered.values()) if delivered else handled
+    query_count = queries.total() - start_queries
+    return {
+        "scenario": scenario.name,
+        "updates": len(updates),
+        "handled": len(done),
+        "errors": len(errors),
+        "seconds": round(handled - first, 4),
+        "updates_per_second": round(len(done) / (handled - first), 1) if handled > first else 0.0,
+        "p50_ms": round(percentile(handler_times, 50) * 1000, 2),
+        "p95_ms": round(percentile(handler_times, 95) * 1000, 2),
+        "p99_ms": round(percentile(handler_times, 99) * 1000, 2),
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "queries": query_count,
+        "queries_per_update": round(query_count / max(1, len(updates)), 2),
+        "query_kinds": dict(queries.counts),
+        "api_calls": dict(api_calls),
+    }
+
+COLUMNS = ["updates", "errors", "updates_per_second", "p50_ms", "p95_ms", "p99_ms", "latency_p50_ms", "latency_p99_ms", "queries_per_update"]
+
+def report(results, baseline):
+    print(f"{'scenario':<15}" + "".join(f"{c:>22}" for c in COLUMNS))
+    for result in results:
+        line = f"{result['scenario']:<15}"
+        for c in COLUMNS:
+            cell = f"{result[c]}"
+            previous = baseline.get(result["scenario"], {}).get(c)
+            if previous:
+                cell += f" ({(result[c] - previous) / previous:+.0%})"
+            line += f"{cell:>22}"
+        print(line)
+        print(f"{'':<15}api calls: {result['api_calls']}")
+        print(f"{'':<15}statements: {result['query_kinds']}")
+
+async def main(args):
+    api = FakeBotApiProcess(args.api_latency).start()
+    factory = UpdateFactory()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for name in args.scenarios:
+                for run in range(args.repeat):
+                    scenario = SCENARIOS[name](args.scale, random.Random(args.seed + run))
+                    results.append(await run_scenario(scenario, api, factory, args, directory, run))
+    finally:
+        api.stop()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replays scripted scenarios against the bot with a local fake Bot API")
+    parser.add_argument("scenarios", nargs="*", help=f"Any of {', '.join(SCENARIOS)}, all of them by default")
+    parser.add_argument("--scale", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Seconds the fake API takes to answer each call")
+    # Telegram's limits are off by default so the numbers measure the bot rather than the rate limiter
+    parser.add_argument("--global-rate", type=float, default=1e6)
+    parser.add_argument("--chat-rate", type=float, default=1e6)
+    parser.add_argument("--chat-burst", type=int, default=1000000)
+    parser.add_argument("--fanout-delay", type=float, default=0.2)
+    parser.add_argument("--concurrent-updates", type=int, default=32)
+    parser.add_argument("--db-pool-size", type=int, default=4)
+    parser.add_argument("--db-synchronous", choices=["OFF", "NORMAL", "FULL", "EXTRA"], default="NORMAL")
+    parser.add_argument("--vote-buffer-ms", type=float, default=None)
+    parser.add_argument("--vote-buffer-size", type=int, default=256)
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Results written by --json of an earlier run, to show the change of each number")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    results = asyncio.run(main(args))
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {r["scenario"]: r for r in json.load(f)}
+    report(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if any(r["errors"] or r["handled"] < r["updates"] for r in results):
+        sys.exit(1)
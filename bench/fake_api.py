@@ -0,0 +1,161 @@
+import json
+import threading
+import multiprocessing
+from time import monotonic, sleep
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+from urllib.request import urlopen, Request
+from collections import Counter
+
+class FakeBotApi:
+    # Local stand-in for the Bot API: serves queued updates through getUpdates and records every call the bot makes.
+    # Bots talk to it through base_url, e.g. Bot(..., base_url=api.base_url).
+    # Paths under /bench/ drive it: push queues updates, stats returns what was recorded, reset forgets it.
+    BOT_USER = {"id": 1000, "is_bot": True, "first_name": "WorksForMeBot", "username": "WorksForMeBot"}
+    def __init__(self, latency = 0.0, host = "127.0.0.1", port = 0):
+        self.latency = latency
+        self.updates = []
+        self.delivered = {}
+        self.counts = Counter()
+        self.first_calls = {}
+        self.message_id = 0
+        self.condition = threading.Condition()
+        api = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, with Nagle every response would wait for a delayed ACK
+            disable_nagle_algorithm = True
+            def log_message(self, *args):
+                pass
+            def do_POST(self):
+                api.handle(self)
+            do_GET = do_POST
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+    def serve(self):
+        self.server.serve_forever()
+    @staticmethod
+    def parameters(request):
+        body = request.rfile.read(int(request.headers.get("Content-Length", 0)))
+        content_type = request.headers.get("Content-Type", "")
+        if "json" in content_type:
+            return json.loads(body or b"{}")
+        if "multipart" in content_type:
+            return {}
+        return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+    def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = monotonic() + float(params.get("timeout") or 0)
+        with self.condition:
+            while True:
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+                if self.updates or monotonic() >= deadline:
+                    break
+                self.condition.wait(deadline - monotonic())
+            batch = self.updates[:limit]
+            now = monotonic()
+            for u in batch:
+                self.delivered.setdefault(u["update_id"], now)
+            return batch
+    def message(self, params):
+        with self.condition:
+            self.message_id += 1
+            message_id = self.message_id
+        chat_id = int(params.get("chat_id") or 0)
+        return {"message_id": message_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+    def control(self, action, params):
+        with self.condition:
+            match action:
+                case "push":
+                    self.updates.extend(params)
+                    self.condition.notify_all()
+                    return True
+                case "stats":
+                    return {"counts": self.counts, "delivered": self.delivered}
+                case "first_calls":
+                    return self.first_calls
+                case "reset":
+                    self.updates.clear()
+                    self.counts.clear()
+                    self.delivered.clear()
+                    self.first_calls.clear()
+                    return True
+    def result(self, method, params):
+        match method:
+            case "getMe":
+                return FakeBotApi.BOT_USER
+            case "getUpdates":
+                return self.get_updates(params)
+            case "sendMessage" | "sendDocument":
+                return self.message(params)
+            case "editMessageText":
+                # Inline messages only get True back, chat messages get the edited message
+                return True if "inline_message_id" in params else self.message(params)
+            case _:
+                return True
+    def handle(self, request):
+        path = request.path.split("/")
+        params = FakeBotApi.parameters(request)
+        if path[1] == "bench":
+            result = self.control(path[2], params)
+        else:
+            method = path[-1]
+            with self.condition:
+                self.first_calls.setdefault(method, monotonic())
+            if method != "getUpdates":
+                with self.condition:
+                    self.counts[method] += 1
+                if self.latency:
+                    sleep(self.latency)
+            result = self.result(method, params)
+        body = json.dumps({"ok": True, "result": result}).encode()
+        try:
+            request.send_response(200)
+            request.send_header("Content-Type", "application/json")
+            request.send_header("Content-Length", str(len(body)))
+            request.end_headers()
+            request.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The bot gave up on a long poll while stopping
+            pass
+
+class FakeBotApiProcess:
+    # Runs the fake API in its own process, so serving the bot's calls doesn't compete with the bot for the GIL.
+    # Both processes read the same monotonic clock, delivery times can be compared with the bot's own.
+    def __init__(self, latency = 0.0):
+        self.latency = latency
+        self.process = None
+        self.base_url = None
+    @staticmethod
+    def run(latency, connection):
+        api = FakeBotApi(latency)
+        connection.send(api.base_url)
+        api.serve()
+    def start(self):
+        parent, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=FakeBotApiProcess.run, args=(self.latency, child), daemon=True)
+        self.process.start()
+        self.base_url = parent.recv()
+        return self
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+    def control(self, action, params = None):
+        request = Request(f"{self.base_url.rsplit('/', 1)[0]}/bench/{action}", json.dumps(params).encode(), {"Content-Type": "application/json"})
+        with urlopen(request) as response:
+            return json.load(response)["result"]
+    def push(self, *updates):
+        self.control("push", list(updates))
+    def reset(self):
+        self.control("reset")
+    def first_calls(self):
+        # When each method was first called since the last reset, on the monotonic clock
+        return self.control("first_calls")
+    def stats(self):
+        stats = self.control("stats")
+        return Counter(stats["counts"]), {int(k): v for k, v in stats["delivered"].items()}
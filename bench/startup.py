@@ -0,0 +1,133 @@
+# Measures a cold start: the bot is started as its own process against the fake Bot API, with updates already waiting for it,
+# and the time is taken from starting the process until those updates are answered.
+#   python bench/startup.py [--runs N] [--plans N] [--module] [--script works-for-me.py] [-- extra bot arguments]
+import os
+import sys
+import json
+import signal
+import random
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+from time import monotonic, sleep
+from statistics import median
+from fake_api import FakeBotApiProcess
+from bench import UpdateFactory, TOKEN, WORDS, DAYS
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "works-for-me.py")
+PHASES = ["getMe", "getUpdates", "first_reply", "all_replies"]
+
+def load(script):
+    # The database is built by the same script that's started, so an older version can be measured against its own schema
+    spec = importlib.util.spec_from_file_location("works_for_me", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def populate(wfm, dbname, plans, rng):
+    # Plans posted in chats and voted on, the most recent ones are the ones the waiting votes go to
+    repo = wfm.Repository(dbname)
+    repo.create_database()
+    planids = []
+    for i in range(plans):
+        planid = repo.start_plan_creation(f"{rng.choice(WORDS)} on {rng.choice(DAYS)} #{i}", 1)
+        for day in rng.sample(DAYS, 5):
+            repo.add_option(day, planid)
+        repo.plan_ready(planid)
+        repo.add_posted_message(planid, f"IM{planid}")
+        options = [o["rowid"] for o in repo.get_all_options(planid)]
+        for userid in range(100, 100 + rng.randrange(5, 50)):
+            repo.cycle_vote(rng.choice(options), userid, f"user{userid}")
+        planids.append((planid, options))
+    repo.close()
+    return planids
+
+def waiting_updates(factory: UpdateFactory, planids, votes, rng):
+    updates = [factory.message(1, "/start")]
+    recent = planids[-20:]
+    for _ in range(votes):
+        planid, options = rng.choice(recent)
+        updates.append(factory.callback(rng.randrange(1000, 2000), f"v|{planid}|{rng.choice(options)}", f"IM{planid}"))
+    return factory.number(updates)
+
+def run(api: FakeBotApiProcess, args, dbname, updates):
+    api.reset()
+    api.push(*updates)
+    if args.module:
+        command = [sys.executable, "-m", os.path.splitext(os.path.basename(args.script))[0]]
+    else:
+        command = [sys.executable, args.script]
+    command += [TOKEN, dbname, "WorksForMeBot", "--api-base-url", api.base_url, "--maintenance-interval", "0"] + args.bot_args
+    started = monotonic()
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(args.script)), stdout=subprocess.DEVNULL)
+    expected = len(updates)
+    finished = None
+    try:
+        deadline = started + args.timeout
+        while monotonic() < deadline:
+            counts, _ = api.stats()
+            if counts["sendMessage"] + counts["answerCallbackQuery"] >= expected:
+                finished = monotonic()
+                break
+            if process.poll() is not None:
+                raise RuntimeError(f"The bot exited with {process.returncode}")
+            sleep(0.002)
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    if finished is None:
+        raise RuntimeError("The bot didn't answer every update in time")
+    first = api.first_calls()
+    return {
+        "getMe": first["getMe"] - started,
+        "getUpdates": first["getUpdates"] - started,
+        "first_reply": min(first[m] for m in ("sendMessage", "answerCallbackQuery") if m in first) - started,
+        "all_replies": finished - started,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the bot's startup until it answered updates waiting for it")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--plans", type=int, default=500)
+    parser.add_argument("--votes", type=int, default=50, help="Votes waiting along with a /start")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--script", default=SCRIPT)
+    parser.add_argument("--module", action="store_true", help="Start the bot with python -m, so its compiled code is cached as for an imported module")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Results written by --json of an earlier run, to show the change of each number")
+    parser.add_argument("bot_args", nargs=argparse.REMAINDER, help="Passed on to the bot, after --")
+    args = parser.parse_args()
+    if args.bot_args[:1] == ["--"]:
+        args.bot_args = args.bot_args[1:]
+    rng = random.Random(args.seed)
+    api = FakeBotApiProcess().start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            dbname = os.path.join(directory, "startup.db")
+            planids = populate(load(args.script), dbname, args.plans, rng)
+            factory = UpdateFactory()
+            runs = [run(api, args, dbname, waiting_updates(factory, planids, args.votes, rng)) for _ in range(args.runs)]
+    finally:
+        api.stop()
+    results = {phase: round(median(r[phase] for r in runs) * 1000, 1) for phase in PHASES}
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print(f"median of {args.runs} runs, ms after starting the process")
+    for phase in PHASES:
+        line = f"{phase:<14}{results[phase]:>10}"
+        if baseline.get(phase):
+            line += f" ({(results[phase] - baseline[phase]) / baseline[phase]:+.0%})"
+        print(line)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# Measures what moving voter names to the users table saves: builds a database with the schema from before it,
+# then migrates it and compares the file size and the time get_answers_formatted takes.
+#   python bench/users_migration.py [--plans N] [--options N] [--voters N] [--users N]
+import os
+import random
+import argparse
+import tempfile
+import importlib.util
+from time import perf_counter
+
+spec = importlib.util.spec_from_file_location("works_for_me", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "works-for-me.py"))
+wfm = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(wfm)
+
+USERS_MIGRATION = 6
+# get_answers_formatted as it was while the names were stored in answers
+OLD_ANSWERS_FORMATTED = """
+SELECT
+    o.rowid,
+    o.option,
+    GROUP_CONCAT(IIF(a.answer = ?, a.answeringUserName, NULL), ", ") As confirmedPeople,
+    SUM(IIF(a.answer = ?, 1, 0)) As confirmedPeopleNumber,
+    GROUP_CONCAT(IIF(a.answer = ?, a.answeringUserName, NULL), ", ") As maybePeople,
+    SUM(IIF(a.answer = ?, 1, 0)) As maybePeopleNumber
+FROM
+    options o
+    LEFT JOIN answers a ON o.rowid = a.optionId
+WHERE
+    o.planId = ?
+GROUP BY
+    o.rowid
+"""
+
+def populate(repo: wfm.Repository, args, rng):
+    users = [(userid, f"{rng.choice(['Anna', 'Marco', 'Giulia', 'Luca', 'Sofia', 'Matteo'])} {rng.choice(['Rossi', 'Bianchi', 'Esposito', 'Romano', 'Colombo'])} (@user{userid})") for userid in range(1, args.users + 1)]
+    with repo.connection() as conn:
+        cursor = conn.cursor()
+        for planid in range(1, args.plans + 1):
+            creator = rng.choice(users)[0]
+            cursor.execute("INSERT INTO plans (rowid, creatorUserId, question, enabled, creationDate) VALUES (?, ?, ?, 1, '2024-01-01')", (planid, creator, f"Plan {planid}",))
+            options = []
+            for number in range(args.options):
+                options.append(cursor.execute("INSERT INTO options (planId, option) VALUES (?, ?)", (planid, f"Option {number}",)).lastrowid)
+            answers = []
+            for userid, name in rng.sample(users, min(args.voters, len(users))):
+                for optionid in options:
+                    answers.append((optionid, userid, name, rng.choice((wfm.Repository.ANSWER_NO, wfm.Repository.ANSWER_YES, wfm.Repository.ANSWER_IF_NECESSARY))))
+            cursor.executemany("INSERT INTO answers (optionId, answeringUserId, answeringUserName, answer) VALUES (?, ?, ?, ?)", answers)
+        conn.commit()
+
+def size(repo: wfm.Repository):
+    # Free pages are given back first, as maintenance would
+    with repo.connection() as conn:
+        conn.cursor().execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        conn.executescript("PRAGMA incremental_vacuum;")
+        conn.cursor().execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        answers = conn.cursor().execute("SELECT SUM(pgsize) AS size FROM dbstat WHERE name IN ('answers', 'answersOptionUser', 'answersOptionAnswer', 'answersOptionAnswerUser')").fetchone()["size"]
+    return os.path.getsize(repo.dbname), answers
+
+def timed(query, plans, repeat):
+    started = perf_counter()
+    for _ in range(repeat):
+        for planid in plans:
+            query(planid)
+    return (perf_counter() - started) / (repeat * len(plans))
+
+def old_answers_formatted(repo: wfm.Repository, planid):
+    with repo.connection() as conn:
+        return conn.cursor().execute(OLD_ANSWERS_FORMATTED, (wfm.Repository.ANSWER_YES, wfm.Repository.ANSWER_YES, wfm.Repository.ANSWER_IF_NECESSARY, wfm.Repository.ANSWER_IF_NECESSARY, planid,)).fetchall()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--plans", type=int, default=200)
+    parser.add_argument("--options", type=int, default=10)
+    parser.add_argument("--voters", type=int, default=100, help="Users answering each plan")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        repo = wfm.Repository(os.path.join(directory, "users.db"))
+        migrations = wfm.Repository.MIGRATIONS
+        wfm.Repository.MIGRATIONS = migrations[:USERS_MIGRATION - 1]
+        try:
+            repo.create_database()
+        finally:
+            wfm.Repository.MIGRATIONS = migrations
+        populate(repo, args, rng)
+        plans = rng.sample(range(1, args.plans + 1), min(args.plans, 50))
+        before = size(repo), timed(lambda planid: old_answers_formatted(repo, planid), plans, args.repeat)
+        wfm.Repository.MIGRATIONS = migrations[:USERS_MIGRATION]
+        try:
+            with repo.connection() as conn:
+                started = perf_counter()
+                wfm.Repository.apply_migrations(conn)
+                migration = perf_counter() - started
+        finally:
+            wfm.Repository.MIGRATIONS = migrations
+        after = size(repo), timed(repo.get_answers_formatted, plans, args.repeat)
+        repo.close()
+    print(f"{args.plans} plans, {args.options} options, {args.voters} voters each: {args.plans * args.options * args.voters} answers by {args.users} users")
+    print(f"migration took {migration * 1000:.0f} ms")
+    print(f"{'':24}{'before':>14}{'after':>14}{'change':>10}")
+    for name, old, new in (("database bytes", before[0][0], after[0][0]), ("answers bytes", before[0][1], after[0][1]), ("get_answers_formatted ms", before[1] * 1000, after[1] * 1000)):
+        print(f"{name:24}{old:>14.{0 if 'bytes' in name else 3}f}{new:>14.{0 if 'bytes' in name else 3}f}{(new - old) / old * 100:>+9.0f}%")
+
+if __name__ == '__main__':
+    main()
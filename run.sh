@@ -1,2 +1,11 @@
 #!/bin/bash
-python /works-for-me.py $BOT_TOKEN /data/data.db $BOT_NAME
\ No newline at end of file
+# Set WEBHOOK_URL to receive updates through a webhook instead of polling, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH and WEBHOOK_SECRET are optional.
+MODE_ARGS=()
+if [ -n "$WEBHOOK_URL" ]; then
+    MODE_ARGS=(--mode webhook --webhook-url "$WEBHOOK_URL" --webhook-listen "${WEBHOOK_LISTEN:-0.0.0.0}" --webhook-port "${WEBHOOK_PORT:-8443}" --webhook-path "${WEBHOOK_PATH:-}")
+    if [ -n "$WEBHOOK_SECRET" ]; then
+        MODE_ARGS+=(--webhook-secret "$WEBHOOK_SECRET")
+    fi
+fi
+cd /
+exec python -m works-for-me $BOT_TOKEN /data/data.db $BOT_NAME "${MODE_ARGS[@]}" $BOT_OPTIONS
\ No newline at end of file
@@ -1,40 +1,374 @@
-from multiprocessing import current_process
-from telegram import CallbackQuery, Update, InlineQueryResultArticle, InputTextMessageContent, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, CommandHandler, InlineQueryHandler, CallbackContext, CallbackQueryHandler, Application, filters
+import sys
+# python-telegram-bot imports tornado for webhooks even when polling, and tornado sets up two TLS contexts as it's imported,
+# together a good part of the startup. Without it the library just reports webhooks as unavailable.
+if __name__ == '__main__' and not any(arg.endswith("webhook") for arg in sys.argv[1:]):
+    sys.modules["tornado"] = None
+from telegram import CallbackQuery, Update, InlineQueryResultArticle, InputTextMessageContent, InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultsButton
+from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, CommandHandler, InlineQueryHandler, CallbackContext, CallbackQueryHandler, ChosenInlineResultHandler, TypeHandler, Application, BaseUpdateProcessor, filters
+from telegram.error import BadRequest, RetryAfter, TimedOut, NetworkError, TelegramError
 import sqlite3
-from asyncio import sleep
+import asyncio
+import multiprocessing
+import signal
+import zlib
+import threading
+import queue
+import argparse
+import json
+import csv
+import io
+import re
+import unicodedata
+from contextlib import contextmanager
+from collections import OrderedDict
+from tempfile import SpooledTemporaryFile
+from bisect import bisect_left
+from asyncio import sleep, get_running_loop, create_task, wait_for, PriorityQueue, Semaphore, Lock
+from time import monotonic, time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from sqlite3 import Error
-import sys
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+
+class ConnectionPool:
+    dbname: str = None
+    size: int = 4
+    synchronous: str = "NORMAL"
+    cached_statements: int = 128
+    def __init__(self, dbname, size = 4, synchronous = "NORMAL", cached_statements = 128):
+        self.dbname = dbname
+        self.size = size
+        self.synchronous = synchronous
+        self.cached_statements = cached_statements
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        self.closed = False
+    def open(self):
+        # check_same_thread is off because a connection can be released on a different thread than the one that opened it,
+        # the pool guarantees that a connection is only ever used by one thread at a time.
+        conn = sqlite3.connect(self.dbname, check_same_thread=False, cached_statements=self.cached_statements)
+        conn.row_factory = Repository.dict_factory
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        conn.execute("PRAGMA busy_timeout = 5000")
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.closed:
+                raise Error("The connection pool is closed")
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+        if can_open:
+            try:
+                return self.open()
+            except:
+                with self.lock:
+                    self.opened -= 1
+                raise
+        return self.idle.get()
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except Error:
+            self.discard(conn)
+            return
+        with self.lock:
+            closed = self.closed
+        if closed:
+            self.discard(conn)
+        else:
+            self.idle.put(conn)
+    def discard(self, conn):
+        with self.lock:
+            self.opened -= 1
+        conn.close()
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+    def close(self):
+        with self.lock:
+            self.closed = True
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(conn)
+
+class TallyCache:
+    max_plans: int = 1024
+    max_options: int = 65536
+    def __init__(self, max_plans = 1024, max_options = 65536):
+        self.max_plans = max_plans
+        self.max_options = max_options
+        self.entries = OrderedDict()
+        self.options_count = 0
+        self.clock = 0
+        self.filling = {}
+        self.writing = {}
+        self.lock = threading.Lock()
+    # Entries are only ever built from a database read that no write to the same plan overlapped with,
+    # after that they're kept current by applying vote deltas in place.
+    def get(self, planid):
+        with self.lock:
+            entry = self.entries.get(planid)
+            if entry is None:
+                return None
+            self.entries.move_to_end(planid)
+            return entry["plan"], [dict(option) for option in entry["options"]]
+    def version(self, planid):
+        with self.lock:
+            entry = self.entries.get(planid)
+            return entry["version"] if entry else None
+    def begin_fill(self, planid):
+        with self.lock:
+            if self.writing.get(planid):
+                return None
+            token = object()
+            self.filling[planid] = token
+            return token
+    def finish_fill(self, planid, token, plan, options):
+        with self.lock:
+            if token is None or self.filling.get(planid) is not token:
+                return
+            del self.filling[planid]
+            if plan is None:
+                return
+            self.drop(planid)
+            self.clock += 1
+            self.entries[planid] = {"plan": plan, "options": [dict(option) for option in options], "version": self.clock}
+            self.options_count += len(options)
+            while self.entries and (len(self.entries) > self.max_plans or self.options_count > self.max_options):
+                self.drop(next(iter(self.entries)))
+    def begin_write(self, planid):
+        with self.lock:
+            self.writing[planid] = self.writing.get(planid, 0) + 1
+            self.filling.pop(planid, None)
+    def end_write(self, planid, vote_change = None):
+        # vote_change is (optionid, old answer, new answer), anything else invalidates the plan
+        with self.lock:
+            self.writing[planid] -= 1
+            if self.writing[planid] == 0:
+                del self.writing[planid]
+            self.filling.pop(planid, None)
+            entry = self.entries.get(planid)
+            if entry is None:
+                return
+            if vote_change is None:
+                self.drop(planid)
+                return
+            optionid, old, new = vote_change
+            for option in entry["options"]:
+                if option["rowid"] == optionid:
+                    Repository.count_vote_change(option, old, new)
+                    self.clock += 1
+                    entry["version"] = self.clock
+                    return
+            self.drop(planid)
+    @contextmanager
+    def invalidating(self, planid):
+        self.begin_write(planid)
+        try:
+            yield
+        finally:
+            self.end_write(planid)
+    def drop(self, planid):
+        entry = self.entries.pop(planid, None)
+        if entry:
+            self.options_count -= len(entry["options"])
+
+class SearchCache:
+    ttl: float = 15.0
+    max_users: int = 10000
+    max_queries: int = 16
+    def __init__(self, ttl = 15.0, max_users = 10000, max_queries = 16):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.max_queries = max_queries
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.versions = OrderedDict()
+        self.evicted_version = 0
+        self.lock = threading.Lock()
+    @staticmethod
+    def tokenize(text):
+        # Mirrors the unicode61 tokenizer with remove_diacritics closely enough to filter cached results in memory
+        text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+        return re.findall(r"[^\W_]+", text.lower())
+    @staticmethod
+    def matches(tokens, question):
+        words = SearchCache.tokenize(question)
+        return all(any(word.startswith(token) for word in words) for token in tokens)
+    def get(self, userid, tokens, limit):
+        with self.lock:
+            entry = self.entries.get(userid)
+            if entry is None:
+                return None
+            if monotonic() - entry["created"] > self.ttl:
+                del self.entries[userid]
+                return None
+            self.entries.move_to_end(userid)
+            queries = entry["queries"]
+            if tokens in queries:
+                queries.move_to_end(tokens)
+                return queries[tokens][:limit]
+            # A complete result for a broader query (every cached token is a prefix of one of ours) contains every row we could match,
+            # so typing "din", "dinn", "dinne" only hits the database once.
+            for cached_tokens, rows in queries.items():
+                if len(rows) < entry["limits"][cached_tokens] and all(any(token.startswith(cached) for token in tokens) for cached in cached_tokens):
+                    return list(filter(lambda x: SearchCache.matches(tokens, x["question"]), rows))[:limit]
+            return None
+    def begin_fill(self):
+        with self.lock:
+            return self.generation
+    def finish_fill(self, generation, userid, tokens, limit, rows):
+        with self.lock:
+            if generation != self.generation:
+                return
+            entry = self.entries.get(userid)
+            if entry is None:
+                entry = self.entries[userid] = {"created": monotonic(), "queries": OrderedDict(), "limits": {}}
+                if len(self.entries) > self.max_users:
+                    self.entries.popitem(last=False)
+            entry["queries"][tokens] = rows
+            entry["limits"][tokens] = limit
+            if len(entry["queries"]) > self.max_queries:
+                evicted, _ = entry["queries"].popitem(last=False)
+                del entry["limits"][evicted]
+    def invalidate(self, userid):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(userid, None)
+            self.versions[userid] = self.generation
+            self.versions.move_to_end(userid)
+            if len(self.versions) > self.max_users:
+                self.evicted_version = max(self.evicted_version, self.versions.popitem(last=False)[1])
+    def version(self, userid):
+        # Changes whenever the user's plans may have changed. Users whose version was evicted get one at least as new as any they had,
+        # which can only cause a miss, never a stale hit.
+        with self.lock:
+            return self.versions.get(userid, self.evicted_version)
+
+class VoteJournal:
+    max_votes: int = 256
+    max_delay: float = 0.1
+    def __init__(self, max_votes = 256, max_delay = 0.1):
+        self.max_votes = max_votes
+        self.max_delay = max_delay
+        self.entries = {}
+        self.lock = threading.Lock()
+    # Votes not written yet, by (optionid, userid). "base" is the answer the database holds, readers add the difference to what they read.
+    # A flush commits while holding the lock and readers pin their read snapshot while holding it,
+    # so a reader sees every vote either in the database or in the journal, never in both.
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+    def answer(self, optionid, userid):
+        with self.lock:
+            entry = self.entries.get((optionid, userid))
+            return entry["answer"] if entry else None
+    def record(self, optionid, userid, username, planid, base, answer):
+        with self.lock:
+            entry = self.entries.get((optionid, userid))
+            # Entries are replaced, never changed, so a flush can tell which ones changed while it was writing
+            if entry:
+                base = entry["base"]
+            self.entries[(optionid, userid)] = {"planId": planid, "userName": username, "base": base, "answer": answer}
+    def pending(self):
+        with self.lock:
+            return list(self.entries.items())
+    def changes(self, planid):
+        # Only call with the lock held
+        return [(optionid, entry["base"], entry["answer"]) for (optionid, userid), entry in self.entries.items() if entry["planId"] == planid]
+    @contextmanager
+    def committing(self, votes):
+        with self.lock:
+            yield
+            for key, entry in votes:
+                current = self.entries.get(key)
+                if current is entry:
+                    del self.entries[key]
+                elif current is not None:
+                    current["base"] = entry["answer"]
 
 class Repository:
     ANSWER_NO = 0
     ANSWER_YES = 1
     ANSWER_IF_NECESSARY = 2
+    # Runs before every answer written, in the same transaction, so every answer has its user.
+    # A name that didn't change isn't written again.
+    UPSERT_USER = "INSERT INTO users (userId, userName) VALUES (?, ?) ON CONFLICT (userId) DO UPDATE SET userName = excluded.userName WHERE userName != excluded.userName"
     dbname: str = None
-    def __init__(self, dbname):
+    pool: ConnectionPool = None
+    tallies: TallyCache = None
+    searches: SearchCache = None
+    votes: VoteJournal = None
+    def __init__(self, dbname, pool_size = 4, synchronous = "NORMAL", cached_statements = 128, tally_cache_plans = 1024, tally_cache_options = 65536, search_cache_ttl = 15.0,
+            vote_buffer_delay = None, vote_buffer_size = 256):
         self.dbname = dbname
+        self.pool = ConnectionPool(dbname, pool_size, synchronous, cached_statements)
+        self.tallies = TallyCache(tally_cache_plans, tally_cache_options)
+        self.searches = SearchCache(search_cache_ttl)
+        # Without a delay every vote is committed on its own
+        if vote_buffer_delay:
+            self.votes = VoteJournal(vote_buffer_size, vote_buffer_delay)
+        self.plan_listeners = []
     @staticmethod
     def dict_factory(cursor: sqlite3.Cursor, row):
         d = {}
         for idx, col in enumerate(cursor.description):
             d[col[0]] = row[idx]
         return d
-    def connect(self):
-        conn = sqlite3.connect(self.dbname)
-        conn.row_factory = Repository.dict_factory
-        return conn
-    def create_database(self):
-        conn = None
-        try:
-            conn = self.connect()
-            Repository.ensure_tables_existance(conn)
-        finally:
-            if conn:
-                conn.close()
+    def connection(self):
+        return self.pool.connection()
+    @contextmanager
+    def changing_plan(self, planid):
+        # Pending votes go first, so they can't land on an option deleted, or a rowid reused, in the meantime
+        self.flush_votes()
+        with self.tallies.invalidating(planid):
+            yield
+        for listener in self.plan_listeners:
+            listener(planid)
+    def forget_plan(self, planid):
+        with self.tallies.invalidating(planid):
+            pass
+    def close(self):
+        self.flush_votes()
+        self.pool.close()
+    def create_database(self, vacuum = False):
+        with self.connection() as conn:
+            Repository.enable_incremental_vacuum(conn, vacuum)
+            Repository.apply_migrations(conn)
     @staticmethod
-    def ensure_tables_existance(conn):
-        statements = ["""
+    def enable_incremental_vacuum(conn, vacuum = False):
+        # A new database takes auto_vacuum as it is, before its first table. One that already has tables only takes it through a VACUUM
+        # rewriting the whole file, which blocks startup and needs as much free disk space again, so that's only done when asked for.
+        if conn.cursor().execute("PRAGMA auto_vacuum").fetchone()["auto_vacuum"] == 2:
+            return
+        if conn.cursor().execute("SELECT 1 FROM sqlite_schema LIMIT 1").fetchone() is not None:
+            if not vacuum:
+                print("The database doesn't give unused pages back to the file system, start once with --db-vacuum to convert it")
+                return
+            print("Converting the database to incremental vacuum, this rewrites the whole file")
+        conn.cursor().execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.cursor().execute("VACUUM")
+    # Each entry upgrades the schema by one PRAGMA user_version step, append new steps at the end and never edit applied ones.
+    # Statements must be safe to run against databases created before migrations were tracked (user_version 0).
+    MIGRATIONS = [
+        [
+            """
             CREATE TABLE IF NOT EXISTS plans(
                 rowid INTEGER PRIMARY KEY AUTOINCREMENT,
                 creatorUserId INTEGER NOT NULL,
@@ -60,191 +394,1163 @@ class Repository:
                 answer INTEGER NOT NULL,
                 FOREIGN KEY (optionId) REFERENCES options (rowid) ON DELETE CASCADE
             );
-            """]
-        for statement in statements:
-            conn.cursor().execute(statement)
-    def get_option_name(self, optionid):
-        conn = None
-        try:
-            conn = self.connect()
-            cursor = conn.cursor().execute("SELECT option FROM options WHERE rowid = ?", (optionid,))
-            option = cursor.fetchone()
-            if option is None:
-                return None
-            else:
-                return option["option"]
-        finally:
-            conn.close()
-    def get_current_vote(self, optionid, userid):
-        conn = None
-        try:
-            conn = self.connect()
-            cursor = conn.cursor().execute("SELECT answer FROM answers WHERE optionId = ? AND answeringUserId = ?", (optionid, userid,))
-            answer = cursor.fetchone()
-            if answer is None:
-                return None
-            else:
-                return answer["answer"]
-        finally:
-            conn.close()
-    def update_vote(self, optionid, userid, vote):
-        conn = None
-        try:
-            conn = self.connect()
-            conn.cursor().execute("UPDATE answers SET answer = ? WHERE optionId = ? AND answeringUserId = ?", (vote, optionid, userid,))
-            conn.commit()
-        finally:
-            conn.close()
-    def insert_vote(self, optionid, userid, username, vote):
-        conn = None
-        try:
-            conn = self.connect()
-            conn.cursor().execute("INSERT INTO answers (optionId, answeringUserId, answeringUserName, answer) VALUES (?, ?, ?, ?)", (optionid, userid, username, vote,))
+            """,
+            """
+            DELETE FROM answers WHERE rowid NOT IN (SELECT MAX(rowid) FROM answers GROUP BY optionId, answeringUserId);
+            """,
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS answersOptionUser ON answers(optionId, answeringUserId);
+            """
+        ],
+        [
+            """
+            CREATE INDEX IF NOT EXISTS answersOptionAnswer ON answers(optionId, answer);
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS optionsPlan ON options(planId, option);
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS plansCreatorEnabledDate ON plans(creatorUserId, enabled, creationDate, question);
+            """,
+            """
+            ANALYZE;
+            """
+        ],
+        [
+            """
+            CREATE TABLE IF NOT EXISTS postedMessages(
+                inlineMessageId TEXT PRIMARY KEY,
+                planId INTEGER NOT NULL,
+                postedDate TEXT NOT NULL,
+                FOREIGN KEY (planId) REFERENCES plans (rowid) ON DELETE CASCADE
+            );
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS postedMessagesPlan ON postedMessages(planId);
+            """
+        ],
+        [
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS plansSearch USING fts5(
+                question,
+                creatorUserId,
+                content='plans',
+                content_rowid='rowid',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='1 2 3'
+            );
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS plansSearchInsert AFTER INSERT ON plans BEGIN
+                INSERT INTO plansSearch (rowid, question, creatorUserId) VALUES (new.rowid, new.question, new.creatorUserId);
+            END;
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS plansSearchDelete AFTER DELETE ON plans BEGIN
+                INSERT INTO plansSearch (plansSearch, rowid, question, creatorUserId) VALUES ('delete', old.rowid, old.question, old.creatorUserId);
+            END;
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS plansSearchUpdate AFTER UPDATE OF question ON plans BEGIN
+                INSERT INTO plansSearch (plansSearch, rowid, question, creatorUserId) VALUES ('delete', old.rowid, old.question, old.creatorUserId);
+                INSERT INTO plansSearch (rowid, question, creatorUserId) VALUES (new.rowid, new.question, new.creatorUserId);
+            END;
+            """,
+            """
+            INSERT INTO plansSearch (plansSearch) VALUES ('rebuild');
+            """
+        ],
+        [
+            """
+            CREATE TABLE IF NOT EXISTS userOperations(
+                userId INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                planId INTEGER,
+                optionNumber INTEGER,
+                expiresAt REAL NOT NULL
+            );
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS userOperationsExpiry ON userOperations(expiresAt);
+            """
+        ],
+        [
+            # Before foreign keys were enforced, removing an option left its answers behind, they can't be copied into a table that checks them
+            """
+            DELETE FROM answers WHERE optionId NOT IN (SELECT rowid FROM options);
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS users(
+                userId INTEGER PRIMARY KEY,
+                userName TEXT NOT NULL
+            );
+            """,
+            """
+            INSERT INTO users (userId, userName)
+            SELECT answeringUserId, answeringUserName FROM answers WHERE rowid IN (SELECT MAX(rowid) FROM answers GROUP BY answeringUserId)
+            ON CONFLICT (userId) DO NOTHING;
+            """,
+            """
+            CREATE TABLE answersByUserId(
+                rowid INTEGER PRIMARY KEY AUTOINCREMENT,
+                optionId INTEGER NOT NULL,
+                answeringUserId INTEGER NOT NULL,
+                answer INTEGER NOT NULL,
+                FOREIGN KEY (optionId) REFERENCES options (rowid) ON DELETE CASCADE
+            );
+            """,
+            """
+            INSERT INTO answersByUserId (rowid, optionId, answeringUserId, answer) SELECT rowid, optionId, answeringUserId, answer FROM answers;
+            """,
+            """
+            DROP TABLE answers;
+            """,
+            """
+            ALTER TABLE answersByUserId RENAME TO answers;
+            """,
+            """
+            CREATE UNIQUE INDEX answersOptionUser ON answers(optionId, answeringUserId);
+            """,
+            """
+            CREATE INDEX answersOptionAnswerUser ON answers(optionId, answer, answeringUserId);
+            """,
+            """
+            ANALYZE;
+            """
+        ],
+        [
+            """
+            CREATE TABLE IF NOT EXISTS settings(
+                name TEXT PRIMARY KEY,
+                value NOT NULL
+            );
+            """,
+            """
+            INSERT INTO settings (name, value) VALUES ('maybeWeight', 0.5) ON CONFLICT (name) DO NOTHING;
+            """,
+            # Answer counts and score of every option, kept current by the triggers below in the same transaction as the answers
+            """
+            CREATE TABLE IF NOT EXISTS optionScores(
+                optionId INTEGER PRIMARY KEY,
+                planId INTEGER NOT NULL,
+                confirmedPeopleNumber INTEGER NOT NULL DEFAULT 0,
+                maybePeopleNumber INTEGER NOT NULL DEFAULT 0,
+                score REAL NOT NULL DEFAULT 0,
+                FOREIGN KEY (optionId) REFERENCES options (rowid) ON DELETE CASCADE
+            );
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS optionScoresPlanScore ON optionScores(planId, score DESC, confirmedPeopleNumber DESC, maybePeopleNumber);
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS optionScoresOptionInsert AFTER INSERT ON options BEGIN
+                INSERT INTO optionScores (optionId, planId) VALUES (new.rowid, new.planId);
+            END;
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS optionScoresAnswerInsert AFTER INSERT ON answers BEGIN
+                UPDATE optionScores SET
+                    confirmedPeopleNumber = confirmedPeopleNumber + (new.answer = {ANSWER_YES}),
+                    maybePeopleNumber = maybePeopleNumber + (new.answer = {ANSWER_IF_NECESSARY}),
+                    score = confirmedPeopleNumber + (new.answer = {ANSWER_YES}) + (maybePeopleNumber + (new.answer = {ANSWER_IF_NECESSARY})) * (SELECT value FROM settings WHERE name = 'maybeWeight')
+                WHERE optionId = new.optionId;
+            END;
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS optionScoresAnswerUpdate AFTER UPDATE OF answer ON answers BEGIN
+                UPDATE optionScores SET
+                    confirmedPeopleNumber = confirmedPeopleNumber + (new.answer = {ANSWER_YES}) - (old.answer = {ANSWER_YES}),
+                    maybePeopleNumber = maybePeopleNumber + (new.answer = {ANSWER_IF_NECESSARY}) - (old.answer = {ANSWER_IF_NECESSARY}),
+                    score = confirmedPeopleNumber + (new.answer = {ANSWER_YES}) - (old.answer = {ANSWER_YES})
+                        + (maybePeopleNumber + (new.answer = {ANSWER_IF_NECESSARY}) - (old.answer = {ANSWER_IF_NECESSARY})) * (SELECT value FROM settings WHERE name = 'maybeWeight')
+                WHERE optionId = new.optionId;
+            END;
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS optionScoresAnswerDelete AFTER DELETE ON answers BEGIN
+                UPDATE optionScores SET
+                    confirmedPeopleNumber = confirmedPeopleNumber - (old.answer = {ANSWER_YES}),
+                    maybePeopleNumber = maybePeopleNumber - (old.answer = {ANSWER_IF_NECESSARY}),
+                    score = confirmedPeopleNumber - (old.answer = {ANSWER_YES}) + (maybePeopleNumber - (old.answer = {ANSWER_IF_NECESSARY})) * (SELECT value FROM settings WHERE name = 'maybeWeight')
+                WHERE optionId = old.optionId;
+            END;
+            """,
+            f"""
+            INSERT INTO optionScores (optionId, planId, confirmedPeopleNumber, maybePeopleNumber)
+            SELECT o.rowid, o.planId, SUM(IIF(a.answer = {ANSWER_YES}, 1, 0)), SUM(IIF(a.answer = {ANSWER_IF_NECESSARY}, 1, 0))
+            FROM options o LEFT JOIN answers a ON o.rowid = a.optionId
+            GROUP BY o.rowid
+            ON CONFLICT (optionId) DO NOTHING;
+            """,
+            """
+            UPDATE optionScores SET score = confirmedPeopleNumber + maybePeopleNumber * (SELECT value FROM settings WHERE name = 'maybeWeight');
+            """
+        ],
+        [
+            """
+            CREATE INDEX IF NOT EXISTS postedMessagesDate ON postedMessages(postedDate, planId);
+            """
+        ]
+    ]
+    @staticmethod
+    def schema_version(conn):
+        return conn.cursor().execute("PRAGMA user_version").fetchone()["user_version"]
+    @staticmethod
+    def apply_migrations(conn):
+        if Repository.schema_version(conn) > len(Repository.MIGRATIONS):
+            raise Error(f"The database schema version {Repository.schema_version(conn)} is newer than this bot supports ({len(Repository.MIGRATIONS)})")
+        while Repository.schema_version(conn) < len(Repository.MIGRATIONS):
+            # IMMEDIATE takes the write lock up front, so if another process is migrating we wait and then re-read the version
+            conn.cursor().execute("BEGIN IMMEDIATE")
+            try:
+                version = Repository.schema_version(conn)
+                if version < len(Repository.MIGRATIONS):
+                    for statement in Repository.MIGRATIONS[version]:
+                        conn.cursor().execute(statement)
+                    conn.cursor().execute(f"PRAGMA user_version = {version + 1}")
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+    def rename_user(self, userid, username):
+        # Only users who answered something are stored, anyone else has nothing to rename.
+        # Reading first keeps the usual case, a name that didn't change, from opening a write transaction.
+        with self.connection() as conn:
+            user = conn.cursor().execute("SELECT userName FROM users WHERE userId = ?", (userid,)).fetchone()
+            if user is None or user["userName"] == username:
+                return
+            conn.cursor().execute("UPDATE users SET userName = ? WHERE userId = ?", (username, userid,))
             conn.commit()
-        finally:
-            conn.close()
     def get_all_plans(self, userId):
-        conn = None
-        try:
-            conn = self.connect()
+        with self.connection() as conn:
             cursor = conn.cursor().execute("SELECT rowid, question FROM plans WHERE creatorUserId = ? AND enabled = 1", (userId,))
             rows = cursor.fetchall()
             return rows
-        finally:
-            conn.close()
     def get_plan(self, planid):
-        conn = None
-        try:
-            conn = self.connect()
-            cursor = conn.cursor().execute("SELECT rowid, creatorUserId, question FROM plans WHERE rowid = ?", (planid,))
-            rows = cursor.fetchone()
-            return rows
-        except Error as e:
-            pass
-        finally:
-            conn.close()
+        cached = self.tallies.get(planid)
+        if cached:
+            return cached[0]
+        with self.connection() as conn:
+            try:
+                return Repository.query_plan(conn, planid)
+            except Error as e:
+                pass
+    @staticmethod
+    def query_plan(conn, planid):
+        cursor = conn.cursor().execute("SELECT rowid, creatorUserId, question FROM plans WHERE rowid = ?", (planid,))
+        return cursor.fetchone()
     def get_plan_options_with_results(self, planid):
-        conn = None
-        try:
-            conn = self.connect()
-            options_cursor = conn.cursor().execute("""
-            SELECT
-                o.rowid,
-                o.planId,
-                o.option,
-                SUM(IIF(a.answer = ?, 1, 0)) As confirmedPeopleNumber,
-                SUM(IIF(a.answer = ?, 1, 0)) As maybePeopleNumber
-            FROM
-                options o
-                LEFT JOIN answers a ON o.rowid = a.optionId
-            WHERE
-                o.planId = ?
-            GROUP BY
-                o.rowid
-            """, (Repository.ANSWER_YES, Repository.ANSWER_IF_NECESSARY, planid,))
-            options = options_cursor.fetchall()
-            return options
-        finally:
-            conn.close()
+        cached = self.tallies.get(planid)
+        if cached:
+            return cached[1]
+        token = self.tallies.begin_fill(planid)
+        with self.connection() as conn:
+            changes = self.pending_votes(conn, planid)
+            plan = Repository.query_plan(conn, planid)
+            options = Repository.query_plan_options_with_results(conn, planid)
+            conn.commit()
+        for optionid, old, new in changes:
+            for option in options:
+                if option["rowid"] == optionid:
+                    Repository.count_vote_change(option, old, new)
+        self.tallies.finish_fill(planid, token, plan, options)
+        return options
+    def pending_votes(self, conn, planid):
+        # Opens a read transaction and takes its snapshot while the journal can't change, see VoteJournal
+        if self.votes is None:
+            return []
+        conn.execute("BEGIN")
+        with self.votes.lock:
+            conn.execute("SELECT 1 FROM answers LIMIT 1").fetchall()
+            return self.votes.changes(planid)
+    @staticmethod
+    def count_vote_change(option, old, new):
+        option["confirmedPeopleNumber"] += (new == Repository.ANSWER_YES) - (old == Repository.ANSWER_YES)
+        option["maybePeopleNumber"] += (new == Repository.ANSWER_IF_NECESSARY) - (old == Repository.ANSWER_IF_NECESSARY)
+    @staticmethod
+    def query_plan_options_with_results(conn, planid):
+        options_cursor = conn.cursor().execute("""
+        SELECT o.rowid, o.planId, o.option, s.confirmedPeopleNumber, s.maybePeopleNumber
+        FROM options o JOIN optionScores s ON s.optionId = o.rowid
+        WHERE o.planId = ?
+        ORDER BY o.rowid
+        """, (planid,))
+        return options_cursor.fetchall()
+    @staticmethod
+    def next_vote(vote):
+        match vote:
+            case Repository.ANSWER_YES:
+                return Repository.ANSWER_IF_NECESSARY
+            case Repository.ANSWER_IF_NECESSARY:
+                return Repository.ANSWER_NO
+            case _:
+                return Repository.ANSWER_YES
+    @staticmethod
+    def cycled_vote(vote, steps):
+        # The answer after clicking steps times, negative steps go back. The cycle repeats every three clicks, a missing answer counts as No.
+        if vote is None:
+            vote = Repository.ANSWER_NO
+        for _ in range(steps % 3):
+            vote = Repository.next_vote(vote)
+        return vote
+    def cycle_vote(self, optionid, userid, username, steps = 1):
+        # A full journal is flushed before taking another vote, that's the bound on how many votes a crash can lose
+        if self.votes is not None and len(self.votes) >= self.votes.max_votes:
+            self.flush_votes()
+        with self.connection() as conn:
+            option = conn.cursor().execute("SELECT option, planId FROM options WHERE rowid = ?", (optionid,)).fetchone()
+            if option is None:
+                return None
+            planid = option["planId"]
+            vote_change = None
+            self.tallies.begin_write(planid)
+            try:
+                if self.votes is not None:
+                    answer = self.journal_vote(conn, optionid, userid, username, planid, steps)
+                else:
+                    answer = Repository.write_vote(conn, optionid, userid, username, steps)
+                    if answer is None:
+                        return None
+                vote_change = (optionid, Repository.cycled_vote(answer, -steps), answer)
+            finally:
+                self.tallies.end_write(planid, vote_change)
+        version = self.tallies.version(planid)
+        return {"answer": answer, "option": option["option"], "plan": self.get_plan(planid), "options": self.get_plan_options_with_results(planid), "version": version}
+    @staticmethod
+    def write_vote(conn, optionid, userid, username, steps = 1):
+        # Yes -> If necessary -> No -> Yes, a missing answer counts as No. steps clicks are applied at once.
+        # Doing it in a single upsert keeps rapid clicks from racing each other into duplicate rows.
+        conn.cursor().execute(Repository.UPSERT_USER, (userid, username,))
+        cursor = conn.cursor().execute("""
+        INSERT INTO answers (optionId, answeringUserId, answer)
+        SELECT rowid, ?, ? FROM options WHERE rowid = ?
+        ON CONFLICT (optionId, answeringUserId) DO UPDATE SET
+            answer = CASE answer WHEN ? THEN ? WHEN ? THEN ? ELSE ? END
+        RETURNING answer
+        """, (userid, Repository.cycled_vote(Repository.ANSWER_NO, steps), optionid,
+            Repository.ANSWER_YES, Repository.cycled_vote(Repository.ANSWER_YES, steps),
+            Repository.ANSWER_IF_NECESSARY, Repository.cycled_vote(Repository.ANSWER_IF_NECESSARY, steps), Repository.cycled_vote(Repository.ANSWER_NO, steps),))
+        answer = cursor.fetchone()
+        if answer is None:
+            return None
+        conn.commit()
+        return answer["answer"]
+    def journal_vote(self, conn, optionid, userid, username, planid, steps = 1):
+        # Write-behind: the vote only goes to the journal, flush_votes writes it later together with others.
+        # Only the writer thread votes and flushes, so the answer read here can't change until the next flush.
+        current = self.votes.answer(optionid, userid)
+        base = None
+        if current is None:
+            row = conn.cursor().execute("SELECT answer FROM answers WHERE optionId = ? AND answeringUserId = ?", (optionid, userid,)).fetchone()
+            base = current = row["answer"] if row else None
+        answer = Repository.cycled_vote(current, steps)
+        self.votes.record(optionid, userid, username, planid, base, answer)
+        return answer
+    def flush_votes(self):
+        votes = self.votes.pending() if self.votes is not None else []
+        if not votes:
+            return 0
+        with self.connection() as conn:
+            conn.cursor().executemany(Repository.UPSERT_USER, [(userid, entry["userName"],) for (optionid, userid), entry in votes])
+            # Votes for options deleted in the meantime select nothing and are dropped
+            conn.cursor().executemany("""
+            INSERT INTO answers (optionId, answeringUserId, answer)
+            SELECT rowid, ?, ? FROM options WHERE rowid = ?
+            ON CONFLICT (optionId, answeringUserId) DO UPDATE SET answer = excluded.answer
+            """, [(userid, entry["answer"], optionid,) for (optionid, userid), entry in votes])
+            with self.votes.committing(votes):
+                conn.commit()
+        return len(votes)
     def get_all_plans_filtered(self, userId, filter, max_rows_filter):
-        conn = None
-        try:
-            conn = self.connect()
-            plan_cursor = conn.cursor().execute("SELECT rowid, question FROM plans WHERE creatorUserId = ? AND enabled = 1 AND question LIKE ? ORDER BY creationDate DESC LIMIT ?", (userId, f'%{filter}%', max_rows_filter,))
+        tokens = tuple(SearchCache.tokenize(filter))
+        cached = self.searches.get(userId, tokens, max_rows_filter)
+        if cached is not None:
+            return cached
+        generation = self.searches.begin_fill()
+        with self.connection() as conn:
+            if tokens:
+                # The creator is indexed as a token too, so FTS5 narrows the matches down to this user's plans before touching the plans table.
+                # Every word is matched as a prefix, quoted so FTS5 query syntax in the filter is taken literally.
+                words = " ".join(map(lambda x: f'"{x}"*', tokens))
+                match = f'creatorUserId : "{int(userId)}" AND question : ({words})'
+                plan_cursor = conn.cursor().execute("""
+                SELECT p.rowid, p.question
+                FROM plansSearch s CROSS JOIN plans p ON p.rowid = s.rowid
+                WHERE plansSearch MATCH ? AND p.enabled = 1
+                ORDER BY p.creationDate DESC LIMIT ?
+                """, (match, max_rows_filter,))
+            else:
+                plan_cursor = conn.cursor().execute("SELECT rowid, question FROM plans WHERE creatorUserId = ? AND enabled = 1 ORDER BY creationDate DESC LIMIT ?", (userId, max_rows_filter,))
             plan_rows = plan_cursor.fetchall()
-            return plan_rows
-        finally:
-            conn.close()
+        self.searches.finish_fill(generation, userId, tokens, max_rows_filter, plan_rows)
+        return plan_rows
     def get_all_options(self, planid):
-        conn = None
-        try:
-            conn = self.connect()
-            cursor = conn.cursor().execute("SELECT rowid, planid, option FROM options WHERE planid = ?", (planid,))
+        with self.connection() as conn:
+            cursor = conn.cursor().execute("SELECT rowid, planid, option FROM options WHERE planid = ? ORDER BY rowid", (planid,))
             return cursor.fetchall()
-        finally:
-            conn.close()
     def start_plan_creation(self, title, userid):
-        conn = None
-        try:
-            conn = self.connect()
+        with self.connection() as conn:
             cursor = conn.cursor().execute("INSERT INTO plans (creatorUserId, question, enabled, creationDate) VALUES (?, ?, 0, ?)", (userid, title, datetime.now(tz=timezone.utc),))
             rowid = cursor.lastrowid
             conn.commit()
             return rowid
-        finally:
-            conn.close()
     def plan_ready(self, planid):
-        conn = None
-        try:
-            conn = self.connect()
-            conn.cursor().execute("UPDATE plans SET enabled = 1 WHERE rowid = ?", (planid,))
+        with self.connection() as conn:
+            plan = conn.cursor().execute("UPDATE plans SET enabled = 1 WHERE rowid = ? RETURNING creatorUserId", (planid,)).fetchone()
             conn.commit()
-        finally:
-            conn.close()
+        if plan:
+            self.searches.invalidate(plan["creatorUserId"])
     def delete_plan(self, userid, planid):
-        conn = None
-        try:
-            conn = self.connect()
-            conn.cursor().execute("DELETE FROM answers WHERE optionId IN (SELECT rowid FROM options WHERE planId = ?)", (planid,))
-            conn.cursor().execute("DELETE FROM options WHERE planId = ?", (planid,))
+        # Options, their answers and posted messages go with the plan through ON DELETE CASCADE
+        with self.changing_plan(planid), self.connection() as conn:
             conn.cursor().execute("DELETE FROM plans WHERE creatorUserId = ? AND rowid = ?", (userid, planid,))
             conn.commit()
-        finally:
-            conn.close()
+        self.searches.invalidate(userid)
     def remove_option(self, planid, optionid):
-        conn = None
-        try:
-            conn = self.connect()
+        with self.changing_plan(planid), self.connection() as conn:
             conn.cursor().execute("DELETE FROM options WHERE planid = ? AND rowid = ?", (planid, optionid,))
             conn.commit()
-        finally:
-            conn.close()
     def update_plan_title(self, text, userid, planid):
-        conn = None
-        try:
-            conn = self.connect()
+        with self.changing_plan(planid), self.connection() as conn:
             conn.cursor().execute("UPDATE plans SET question = ? WHERE creatorUserId = ? AND rowid = ?", (text, userid, planid,))
             conn.commit()
-        finally:
-            conn.close()
+        self.searches.invalidate(userid)
     def add_option(self, text, planid):
-        conn = None
-        try:
-            conn = self.connect()
-            conn.cursor().execute("INSERT INTO options (planId, option) VALUES (?, ?)", (planid, text,))
+        with self.changing_plan(planid), self.connection() as conn:
+            conn.cursor().execute("INSERT INTO options (planId, option) SELECT rowid, ? FROM plans WHERE rowid = ?", (text, planid,))
             conn.commit()
-        finally:
-            conn.close()
+    def add_posted_message(self, planid, inline_message_id):
+        with self.connection() as conn:
+            # Selecting the plan instead of inserting its id, so a plan deleted in the meantime isn't a foreign key violation
+            conn.cursor().execute("INSERT INTO postedMessages (inlineMessageId, planId, postedDate) SELECT ?, rowid, ? FROM plans WHERE rowid = ? ON CONFLICT (inlineMessageId) DO NOTHING", (inline_message_id, datetime.now(tz=timezone.utc), planid,))
+            conn.commit()
+    def get_posted_messages(self, planid):
+        with self.connection() as conn:
+            cursor = conn.cursor().execute("SELECT inlineMessageId FROM postedMessages WHERE planId = ?", (planid,))
+            return list(map(lambda x: x["inlineMessageId"], cursor.fetchall()))
+    def is_posted_message(self, inline_message_id):
+        with self.connection() as conn:
+            return conn.cursor().execute("SELECT 1 FROM postedMessages WHERE inlineMessageId = ?", (inline_message_id,)).fetchone() is not None
+    def get_recently_posted_plans(self, limit):
+        # Newest first along the postedMessagesDate index, a plan posted in several chats counts once
+        with self.connection() as conn:
+            planids = {}
+            for row in conn.cursor().execute("SELECT planId FROM postedMessages ORDER BY postedDate DESC"):
+                planids[row["planId"]] = None
+                if len(planids) >= limit:
+                    break
+            return list(planids)
+    def remove_posted_message(self, inline_message_id):
+        with self.connection() as conn:
+            conn.cursor().execute("DELETE FROM postedMessages WHERE inlineMessageId = ?", (inline_message_id,))
+            conn.commit()
+    def set_user_operation(self, userid, kind, planid, option, expires):
+        with self.connection() as conn:
+            conn.cursor().execute("""
+            INSERT INTO userOperations (userId, kind, planId, optionNumber, expiresAt) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (userId) DO UPDATE SET kind = excluded.kind, planId = excluded.planId, optionNumber = excluded.optionNumber, expiresAt = excluded.expiresAt
+            """, (userid, kind, planid, option, expires,))
+            conn.commit()
+    def pop_user_operation(self, userid, now):
+        with self.connection() as conn:
+            operation = conn.cursor().execute("DELETE FROM userOperations WHERE userId = ? RETURNING kind, planId, optionNumber, expiresAt", (userid,)).fetchone()
+            conn.commit()
+            if operation is None or operation["expiresAt"] < now:
+                return None
+            return operation
+    def sweep_user_operations(self, now):
+        with self.connection() as conn:
+            cursor = conn.cursor().execute("DELETE FROM userOperations WHERE expiresAt < ?", (now,))
+            conn.commit()
+            return cursor.rowcount
+    def collect_garbage(self, drafts_created_before):
+        # Deletes plans never finished with /done and rows left behind from before foreign keys were enforced,
+        # then gives the free pages back to the filesystem and lets SQLite refresh its statistics.
+        stats = {}
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            drafts = cursor.execute("DELETE FROM plans WHERE enabled = 0 AND creationDate < ? RETURNING rowid", (drafts_created_before,)).fetchall()
+            stats["drafts"] = len(drafts)
+            stats["options"] = cursor.execute("DELETE FROM options WHERE planId NOT IN (SELECT rowid FROM plans)").rowcount
+            stats["answers"] = cursor.execute("DELETE FROM answers WHERE optionId NOT IN (SELECT rowid FROM options)").rowcount
+            stats["postedMessages"] = cursor.execute("DELETE FROM postedMessages WHERE planId NOT IN (SELECT rowid FROM plans)").rowcount
+            stats["userOperations"] = cursor.execute("DELETE FROM userOperations WHERE planId IS NOT NULL AND planId NOT IN (SELECT rowid FROM plans)").rowcount
+            stats["users"] = cursor.execute("DELETE FROM users WHERE userId NOT IN (SELECT answeringUserId FROM answers)").rowcount
+            conn.commit()
+            page_size = cursor.execute("PRAGMA page_size").fetchone()["page_size"]
+            pages = cursor.execute("PRAGMA page_count").fetchone()["page_count"]
+            # Every step of incremental_vacuum frees one page, but it returns no rows and execute() only takes the first step,
+            # executescript() steps every statement to the end
+            conn.executescript("PRAGMA incremental_vacuum;")
+            stats["reclaimedBytes"] = (pages - cursor.execute("PRAGMA page_count").fetchone()["page_count"]) * page_size
+            cursor.execute("PRAGMA optimize").fetchall()
+        for draft in drafts:
+            self.forget_plan(draft["rowid"])
+            for listener in self.plan_listeners:
+                listener(draft["rowid"])
+        return stats
     def get_answers_formatted(self, planid):
-        conn = None
-        try:
-            conn = self.connect()
+        with self.connection() as conn:
             cursor = conn.cursor().execute("""
             SELECT
                 o.rowid,
                 o.option,
-                GROUP_CONCAT(IIF(a.answer = ?, a.answeringUserName, NULL), ", ") As confirmedPeople,
+                GROUP_CONCAT(IIF(a.answer = ?, u.userName, NULL), ", ") As confirmedPeople,
                 SUM(IIF(a.answer = ?, 1, 0)) As confirmedPeopleNumber,
-                GROUP_CONCAT(IIF(a.answer = ?, a.answeringUserName, NULL), ", ") As maybePeople,
+                GROUP_CONCAT(IIF(a.answer = ?, u.userName, NULL), ", ") As maybePeople,
                 SUM(IIF(a.answer = ?, 1, 0)) As maybePeopleNumber
             FROM
                 options o
                 LEFT JOIN answers a ON o.rowid = a.optionId
+                LEFT JOIN users u ON u.userId = a.answeringUserId
             WHERE
                 o.planId = ?
             GROUP BY
                 o.rowid
             """, (Repository.ANSWER_YES, Repository.ANSWER_YES, Repository.ANSWER_IF_NECESSARY, Repository.ANSWER_IF_NECESSARY, planid,))
             return cursor.fetchall()
+    def get_results_page(self, planid, page, page_size, names_per_answer):
+        # Only one page of options is read, and for each of them only the first names_per_answer names of each answer, the counts are exact.
+        # A page past the end, because options were removed in the meantime, becomes the last one.
+        with self.connection() as conn:
+            options_count = conn.cursor().execute("SELECT COUNT(*) AS count FROM options WHERE planId = ?", (planid,)).fetchone()["count"]
+            page = max(0, min(page, (options_count - 1) // page_size))
+            options = conn.cursor().execute("""
+            SELECT o.rowid, o.option, s.confirmedPeopleNumber, s.maybePeopleNumber
+            FROM options o JOIN optionScores s ON s.optionId = o.rowid
+            WHERE o.planId = ?
+            ORDER BY o.rowid LIMIT ? OFFSET ?
+            """, (planid, page_size, page * page_size,)).fetchall()
+            by_option = {}
+            for option in options:
+                option["confirmedPeople"] = []
+                option["maybePeople"] = []
+                by_option[option["rowid"]] = option
+            names = conn.cursor().execute(f"""
+            SELECT n.optionId, n.answer, u.userName FROM (
+                SELECT optionId, answer, answeringUserId, ROW_NUMBER() OVER (PARTITION BY optionId, answer ORDER BY rowid) AS position
+                FROM answers
+                WHERE optionId IN ({",".join("?" * len(by_option))}) AND answer IN (?, ?)
+            ) n JOIN users u ON u.userId = n.answeringUserId
+            WHERE n.position <= ?
+            ORDER BY n.optionId, n.answer, n.position
+            """, (*by_option, Repository.ANSWER_YES, Repository.ANSWER_IF_NECESSARY, names_per_answer,))
+            for name in names:
+                by_option[name["optionId"]]["confirmedPeople" if name["answer"] == Repository.ANSWER_YES else "maybePeople"].append(name["userName"])
+            return options, options_count, page
+    def get_best_options(self, planid, limit):
+        # Straight from the optionScores index, options nobody answered are left out
+        with self.connection() as conn:
+            cursor = conn.cursor().execute("""
+            SELECT o.rowid, o.option, s.confirmedPeopleNumber, s.maybePeopleNumber, s.score
+            FROM optionScores s JOIN options o ON o.rowid = s.optionId
+            WHERE s.planId = ? AND s.confirmedPeopleNumber + s.maybePeopleNumber > 0
+            ORDER BY s.score DESC, s.confirmedPeopleNumber DESC, s.maybePeopleNumber, s.optionId LIMIT ?
+            """, (planid, limit,))
+            return cursor.fetchall()
+    def set_maybe_weight(self, weight):
+        # How much an "If necessary" counts towards an option's score, relative to a "Yes". Scores are recomputed from the stored counts.
+        with self.connection() as conn:
+            if conn.cursor().execute("SELECT value FROM settings WHERE name = 'maybeWeight'").fetchone()["value"] == weight:
+                return
+            conn.cursor().execute("UPDATE settings SET value = ? WHERE name = 'maybeWeight'", (weight,))
+            conn.cursor().execute("UPDATE optionScores SET score = confirmedPeopleNumber + maybePeopleNumber * ?", (weight,))
+            conn.commit()
+    @staticmethod
+    def answer_rows(conn, planid):
+        cursor = conn.cursor().execute("""
+        SELECT o.option, a.answer, u.userName, a.answeringUserId
+        FROM options o JOIN answers a ON a.optionId = o.rowid JOIN users u ON u.userId = a.answeringUserId
+        WHERE o.planId = ? AND a.answer IN (?, ?)
+        ORDER BY o.rowid, a.answer, a.rowid
+        """, (planid, Repository.ANSWER_YES, Repository.ANSWER_IF_NECESSARY,))
+        while rows := cursor.fetchmany(500):
+            yield from rows
+    def export_answers(self, planid, file, answer_to_text):
+        # Rows go from the cursor to the file a batch at a time, the file is binary and left open for the caller
+        with self.connection() as conn:
+            text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+            writer = csv.writer(text)
+            writer.writerow(["Option", "Answer", "User", "User id"])
+            writer.writerows([row["option"], answer_to_text(row["answer"]), row["userName"], row["answeringUserId"]] for row in Repository.answer_rows(conn, planid))
+            text.flush()
+            text.detach()
+
+
+class Metrics:
+    # Counters and histograms rendered in the Prometheus text format, updated both from the event loop and from the database threads
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    DESCRIPTIONS = {
+        "bot_updates_total": ("counter", "Updates received by type"),
+        "bot_handler_seconds": ("histogram", "Time spent handling an update by handler"),
+        "bot_handler_errors_total": ("counter", "Handlers that failed by handler"),
+        "db_query_seconds": ("histogram", "Time spent in a repository method by method"),
+        "db_errors_total": ("counter", "Repository methods that failed by method"),
+        "db_slow_queries_total": ("counter", "Repository methods slower than the slow query threshold by method"),
+        "telegram_request_seconds": ("histogram", "Time spent in a Bot API request by method"),
+        "telegram_errors_total": ("counter", "Failed Bot API requests by method and error, retry_after is a 429"),
+        "telegram_edits_skipped_total": ("counter", "Edits that didn't reach Telegram by reason"),
+        "db_maintenance_deleted_total": ("counter", "Rows deleted by the maintenance job by kind"),
+        "db_maintenance_reclaimed_bytes_total": ("counter", "Bytes given back to the filesystem by the maintenance job"),
+    }
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.server = None
+    def inc(self, name, amount = 1, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(labels.items()))
+        bucket = bisect_left(Metrics.BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(Metrics.BUCKETS) + 1), 0.0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+    @contextmanager
+    def timer(self, name, errors = None, **labels):
+        start = monotonic()
+        try:
+            yield
+        except Exception:
+            if errors:
+                self.inc(errors, **labels)
+            raise
+        finally:
+            self.observe(name, monotonic() - start, **labels)
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{Metrics.escape(v)}"' for k, v in labels) + "}"
+    @staticmethod
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(buckets), total) for key, (buckets, total) in self.histograms.items()}
+        lines = []
+        for name, (kind, description) in Metrics.DESCRIPTIONS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                lines.extend(f"{name}{Metrics.format_labels(labels)} {value}" for (n, labels), value in counters.items() if n == name)
+                continue
+            for (n, labels), (buckets, total) in histograms.items():
+                if n != name:
+                    continue
+                count = 0
+                for bound, observations in zip(Metrics.BUCKETS + ("+Inf",), buckets):
+                    count += observations
+                    lines.append(f"{name}_bucket{Metrics.format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_sum{Metrics.format_labels(labels)} {total}")
+                lines.append(f"{name}_count{Metrics.format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+    async def start_server(self, host, port):
+        self.server = await asyncio.start_server(self.handle_request, host, port)
+    async def stop_server(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+    async def handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = (await reader.readline()).split()
+            while (await reader.readline()).strip():
+                pass
+            if len(request) > 1 and request[0] == b"GET" and request[1].split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
         finally:
-            conn.close()
+            writer.close()
 
 
-class Bot:
+class AsyncRepository:
+    WRITE_METHODS = {"create_database", "cycle_vote", "start_plan_creation", "plan_ready", "delete_plan", "remove_option", "update_plan_title", "add_option", "add_posted_message", "remove_posted_message",
+        "set_user_operation", "pop_user_operation", "sweep_user_operations", "collect_garbage", "flush_votes", "rename_user", "set_maybe_weight"}
+    # Reads that list who answered what or rank options, pending votes are written before them instead of being overlaid
+    FLUSHING_METHODS = {"get_answers_formatted", "get_results_page", "export_answers", "get_best_options"}
     repo: Repository = None
+    metrics: Metrics = None
+    slow_query_threshold: float = None
+    def __init__(self, repo: Repository, readers = None, metrics = None, slow_query_threshold = None):
+        self.repo = repo
+        self.metrics = metrics or Metrics()
+        self.slow_query_threshold = slow_query_threshold
+        # Writes are funneled through a single thread so they never contend for the SQLite write lock,
+        # reads get the rest of the connection pool.
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self.readers = ThreadPoolExecutor(max_workers=readers or max(1, repo.pool.size - 1), thread_name_prefix="db-reader")
+        self.flush_task = None
+    async def run(self, method, *args, **kwargs):
+        if method in AsyncRepository.FLUSHING_METHODS and self.repo.votes is not None and len(self.repo.votes):
+            await self.run("flush_votes")
+        executor = self.writer if method in AsyncRepository.WRITE_METHODS else self.readers
+        result = await get_running_loop().run_in_executor(executor, partial(self.timed, method, *args, **kwargs))
+        if method == "cycle_vote":
+            self.schedule_flush()
+        return result
+    def schedule_flush(self):
+        if self.flush_task is None and self.repo.votes is not None and len(self.repo.votes):
+            self.flush_task = create_task(self.flush_later())
+    async def flush_later(self):
+        # The first vote into an empty journal starts the clock, so no vote waits longer than max_delay
+        await sleep(self.repo.votes.max_delay)
+        try:
+            await self.run("flush_votes")
+        except Error as e:
+            print(f"Flushing votes failed: {e}")
+        self.flush_task = None
+        self.schedule_flush()
+    def timed(self, method, *args, **kwargs):
+        # Runs on the database thread, so the time doesn't include waiting for the executor
+        start = monotonic()
+        try:
+            with self.metrics.timer("db_query_seconds", "db_errors_total", method=method):
+                return getattr(self.repo, method)(*args, **kwargs)
+        finally:
+            elapsed = monotonic() - start
+            if self.slow_query_threshold is not None and elapsed >= self.slow_query_threshold:
+                self.metrics.inc("db_slow_queries_total", method=method)
+                print(f"Slow query: {method}({', '.join(map(repr, args))}) took {elapsed * 1000:.1f} ms")
+    def __getattr__(self, name):
+        if not callable(getattr(self.repo, name)):
+            return getattr(self.repo, name)
+        async def call(*args, **kwargs):
+            return await self.run(name, *args, **kwargs)
+        return call
+    def close(self):
+        # Votes still in the journal are flushed by the repository once the writer is done
+        if self.flush_task:
+            self.flush_task.cancel()
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
+        self.repo.close()
+
+
+class UserOperation:
+    NEW_PLAN = "n"
+    NEW_PLAN_OPTION = "++"
+    ADD_OPTION = "+"
+    EDIT_QUESTION = "q"
+    kind: str = None
+    planid: int = None
+    option: int = None
+    def __init__(self, kind, planid = None, option = None):
+        self.kind = kind
+        self.planid = planid
+        self.option = option
+
+
+class MemoryOperationStore:
+    ttl: float = 3600
+    def __init__(self, ttl = 3600):
+        self.ttl = ttl
+        self.operations = {}
+    async def set(self, userid, operation: UserOperation):
+        self.operations[userid] = (operation, time() + self.ttl)
+    async def pop(self, userid):
+        entry = self.operations.pop(userid, None)
+        if entry is None or entry[1] < time():
+            return None
+        return entry[0]
+    async def sweep(self):
+        now = time()
+        expired = [userid for userid, entry in self.operations.items() if entry[1] < now]
+        for userid in expired:
+            del self.operations[userid]
+        return len(expired)
+
+
+class SqliteOperationStore:
+    ttl: float = 3600
+    def __init__(self, repo: AsyncRepository, ttl = 3600):
+        self.repo = repo
+        self.ttl = ttl
+    async def set(self, userid, operation: UserOperation):
+        await self.repo.set_user_operation(userid, operation.kind, operation.planid, operation.option, time() + self.ttl)
+    async def pop(self, userid):
+        row = await self.repo.pop_user_operation(userid, time())
+        if row is None:
+            return None
+        return UserOperation(row["kind"], row["planId"], row["optionNumber"])
+    async def sweep(self):
+        return await self.repo.sweep_user_operations(time())
+
+
+class TokenBucket:
+    rate: float = 1.0
+    capacity: float = 1.0
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+    def reserve(self):
+        # Takes a token even if there's none left, the caller must wait the returned number of seconds before using it
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class OutboundJob:
+    def __init__(self, method, call, chat_key, edit_key, fingerprint = None):
+        self.method = method
+        self.call = call
+        self.chat_key = chat_key
+        self.edit_key = edit_key
+        self.fingerprint = fingerprint
+        self.future = get_running_loop().create_future()
+
+
+class OutboundScheduler:
+    PRIORITY_ANSWER = 0
+    PRIORITY_SEND = 1
+    PRIORITY_EDIT = 2
+    MAX_CHAT_BUCKETS = 10000
+    MAX_ANSWERED_QUERIES = 10000
+    MAX_FINGERPRINTS = 50000
+    def __init__(self, bot, global_rate = 30.0, chat_rate = 1.0, chat_burst = 5, max_retries = 3, metrics = None):
+        self.bot = bot
+        self.metrics = metrics or Metrics()
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets = OrderedDict()
+        self.pending_edits = {}
+        self.editing = set()
+        self.answered = OrderedDict()
+        self.fingerprints = OrderedDict()
+        self.queue = None
+        self.sequence = 0
+        self.running = set()
+        self.dispatcher = None
+    def start(self):
+        self.queue = PriorityQueue()
+        self.dispatcher = create_task(self.dispatch())
+    async def stop(self, timeout = 5.0):
+        try:
+            await wait_for(self.drain(), timeout)
+        except TimeoutError:
+            pass
+        self.dispatcher.cancel()
+        for task in list(self.running):
+            task.cancel()
+        while not self.queue.empty():
+            job = self.queue.get_nowait()[2]
+            if not job.future.done():
+                job.future.cancel()
+        for job in self.pending_edits.values():
+            if not job.future.done():
+                job.future.cancel()
+    async def drain(self):
+        while not self.queue.empty() or self.running:
+            await sleep(0.05)
+    @staticmethod
+    def resolved(value):
+        future = get_running_loop().create_future()
+        future.set_result(value)
+        return future
+    @staticmethod
+    def fingerprint(text, reply_markup):
+        return hash((text, json.dumps(reply_markup.to_dict(), sort_keys=True) if reply_markup else None))
+    def submit(self, priority, method, call, chat_key = None, edit_key = None, fingerprint = None):
+        job = OutboundJob(method, call, chat_key, edit_key, fingerprint)
+        if edit_key is not None:
+            # Only the latest content of a message matters, an edit still waiting for its turn is dropped
+            superseded = self.pending_edits.get(edit_key)
+            if superseded and not superseded.future.done():
+                superseded.future.set_result(None)
+                self.metrics.inc("telegram_edits_skipped_total", reason="superseded")
+            self.pending_edits[edit_key] = job
+        self.sequence += 1
+        self.queue.put_nowait((priority, self.sequence, job))
+        return job.future
+    async def dispatch(self):
+        while True:
+            job = (await self.queue.get())[2]
+            if job.future.done():
+                continue
+            if job.edit_key in self.editing:
+                # The message is being edited, the newest edit waiting for it is sent once that's done
+                continue
+            await sleep(self.global_bucket.reserve())
+            task = create_task(self.execute(job))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+    def chat_bucket(self, chat_key):
+        bucket = self.chat_buckets.get(chat_key)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_key] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self.chat_buckets) > OutboundScheduler.MAX_CHAT_BUCKETS:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_key)
+        return bucket
+    async def execute(self, job: OutboundJob):
+        if job.edit_key is not None:
+            await self.execute_edits(job.edit_key, job.chat_key)
+            return
+        if job.chat_key is not None:
+            await sleep(self.chat_bucket(job.chat_key).reserve())
+        if job.future.done():
+            return
+        await self.call(job)
+    async def execute_edits(self, edit_key, chat_key):
+        # Edits of a message go out one at a time, one in flight could otherwise be applied after a newer one.
+        # Each chat token sends the newest edit by the time it's there, edits replaced in the meantime cost nothing.
+        self.editing.add(edit_key)
+        try:
+            while True:
+                await sleep(self.chat_bucket(chat_key).reserve())
+                job = self.pending_edits.pop(edit_key, None)
+                if job is None:
+                    return
+                await self.call(job)
+                if edit_key not in self.pending_edits:
+                    return
+                await sleep(self.global_bucket.reserve())
+        finally:
+            self.editing.discard(edit_key)
+    async def call(self, job: OutboundJob):
+        for attempt in range(self.max_retries + 1):
+            start = monotonic()
+            try:
+                result = await job.call()
+                if not job.future.done():
+                    job.future.set_result(result)
+                return
+            except RetryAfter as e:
+                self.metrics.inc("telegram_errors_total", method=job.method, error="retry_after")
+                error = e
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            except BadRequest as e:
+                if job.edit_key is not None and "not modified" in e.message:
+                    self.metrics.inc("telegram_edits_skipped_total", reason="not_modified")
+                    if not job.future.done():
+                        job.future.set_result(False)
+                    return
+                self.metrics.inc("telegram_errors_total", method=job.method, error="bad_request")
+                error = e
+                break
+            except (TimedOut, NetworkError) as e:
+                self.metrics.inc("telegram_errors_total", method=job.method, error="timed_out" if isinstance(e, TimedOut) else "network")
+                error = e
+                delay = 0.5 * 2 ** attempt
+            except Exception as e:
+                self.metrics.inc("telegram_errors_total", method=job.method, error="other")
+                error = e
+                break
+            finally:
+                self.metrics.observe("telegram_request_seconds", monotonic() - start, method=job.method)
+            if attempt < self.max_retries:
+                await sleep(delay)
+        if job.edit_key is not None and self.fingerprints.get(job.edit_key) == job.fingerprint:
+            del self.fingerprints[job.edit_key]
+        if not job.future.done():
+            job.future.set_exception(error)
+    def answer(self, query: CallbackQuery, text = None, show_alert = False):
+        # Telegram rejects a second answer to the same query, later answers are no-ops
+        if query.id in self.answered:
+            return OutboundScheduler.resolved(None)
+        self.answered[query.id] = True
+        if len(self.answered) > OutboundScheduler.MAX_ANSWERED_QUERIES:
+            self.answered.popitem(last=False)
+        return self.submit(OutboundScheduler.PRIORITY_ANSWER, "answerCallbackQuery", lambda: query.answer(text, show_alert=show_alert))
+    def answer_inline(self, inline_query_id, results, **kwargs):
+        return self.submit(OutboundScheduler.PRIORITY_ANSWER, "answerInlineQuery", lambda: self.bot.answer_inline_query(inline_query_id, results, **kwargs))
+    def send(self, chat_id, text, **kwargs):
+        return self.submit(OutboundScheduler.PRIORITY_SEND, "sendMessage", lambda: self.bot.send_message(chat_id, text, **kwargs), chat_key=chat_id)
+    def send_document(self, chat_id, file, filename, **kwargs):
+        # A retry has to upload the file from the start again
+        async def call():
+            file.seek(0)
+            return await self.bot.send_document(chat_id, file.read(), filename=filename, **kwargs)
+        return self.submit(OutboundScheduler.PRIORITY_SEND, "sendDocument", call, chat_key=chat_id)
+    # Edits resolve to False without calling Telegram when the message already shows the same text and keyboard,
+    # and to None when a newer edit of the same message replaced them before they were sent.
+    def edit(self, query: CallbackQuery, text, reply_markup = None):
+        if query.inline_message_id:
+            return self.edit_inline(query.inline_message_id, text, reply_markup)
+        key = (query.message.chat.id, query.message.message_id)
+        return self.submit_edit(lambda: query.edit_message_text(text, reply_markup=reply_markup), query.message.chat.id, key, OutboundScheduler.fingerprint(text, reply_markup))
+    def edit_inline(self, inline_message_id, text, reply_markup = None):
+        return self.submit_edit(lambda: self.bot.edit_message_text(text, inline_message_id=inline_message_id, reply_markup=reply_markup), inline_message_id, inline_message_id, OutboundScheduler.fingerprint(text, reply_markup))
+    def submit_edit(self, call, chat_key, edit_key, fingerprint):
+        if self.fingerprints.get(edit_key) == fingerprint:
+            self.fingerprints.move_to_end(edit_key)
+            self.metrics.inc("telegram_edits_skipped_total", reason="unchanged")
+            return OutboundScheduler.resolved(False)
+        self.fingerprints[edit_key] = fingerprint
+        self.fingerprints.move_to_end(edit_key)
+        if len(self.fingerprints) > OutboundScheduler.MAX_FINGERPRINTS:
+            self.fingerprints.popitem(last=False)
+        return self.submit(OutboundScheduler.PRIORITY_EDIT, "editMessageText", call, chat_key, edit_key, fingerprint)
+
+class PressFlights:
+    # Single flight for button presses: while a press is handled, identical presses (same button of the same message by the same user)
+    # join it instead of being handled again, and get the same answer. A flight opens as its first press arrives, before it waits for its turn,
+    # so presses received together join too.
+    def __init__(self, kinds):
+        self.kinds = kinds
+        self.open = {}
+        self.boarded = {}
+    @staticmethod
+    def press_key(query: CallbackQuery):
+        return (query.inline_message_id or (query.message.chat.id, query.message.message_id), query.from_user.id, query.data)
+    def arrive(self, update):
+        # True when the update joined a flight, it then only has to wait for the answer
+        if not isinstance(update, Update) or update.callback_query is None or str(update.callback_query.data).split('|')[0] not in self.kinds:
+            return False
+        press = PressFlights.press_key(update.callback_query)
+        flight = self.open.get(press)
+        if flight is None:
+            self.open[press] = self.boarded[update.update_id] = {"press": press, "leader": update.update_id, "presses": 0, "answer": get_running_loop().create_future()}
+            return False
+        flight["presses"] += 1
+        self.boarded[update.update_id] = flight
+        return True
+    def get(self, update: Update):
+        return self.boarded.get(update.update_id)
+    def take(self, flight):
+        # Presses that joined since the last take
+        if flight is None:
+            return 0
+        presses = flight["presses"]
+        flight["presses"] = 0
+        return presses
+    def close(self, flight):
+        # Presses arriving afterwards open a new flight, once the leader took the last presses it must not take any more
+        if flight is not None and self.open.get(flight["press"]) is flight:
+            del self.open[flight["press"]]
+    def land(self, flight, answer = None):
+        if flight is None:
+            return
+        self.close(flight)
+        if not flight["answer"].done():
+            flight["answer"].set_result(answer)
+    def leave(self, update):
+        flight = self.boarded.pop(update.update_id, None)
+        if flight is not None and flight["leader"] == update.update_id:
+            self.land(flight)
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    # Updates are processed concurrently except when they share an ordering key: conversation steps are serialized per user
+    # (they share the pending user operation) and votes per plan and user. An update waiting for its key doesn't hold a processing slot,
+    # the base class limit only bounds how many updates can be waiting at all.
+    def __init__(self, max_concurrent_updates, max_waiting_updates = None, flights: PressFlights = None):
+        super().__init__(max_waiting_updates or max_concurrent_updates * 8)
+        self.running = Semaphore(max_concurrent_updates)
+        self.locks = {}
+        self.flights = flights
+    @staticmethod
+    def ordering_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.callback_query:
+            d = str(update.callback_query.data).split('|')
+            if d[0] == "v" and len(d) > 1:
+                return ("v", d[1], update.callback_query.from_user.id)
+            return ("u", update.callback_query.from_user.id)
+        if update.inline_query or update.chosen_inline_result:
+            return None
+        if update.effective_user:
+            return ("u", update.effective_user.id)
+        return None
+    async def do_process_update(self, update, coroutine):
+        # A press that joined one in flight only waits for its answer, it takes neither its ordering key nor a processing slot
+        joined = self.flights is not None and self.flights.arrive(update)
+        try:
+            if joined:
+                await coroutine
+            else:
+                await self.process_in_order(update, coroutine)
+        finally:
+            if self.flights is not None:
+                self.flights.leave(update)
+    async def process_in_order(self, update, coroutine):
+        key = OrderedUpdateProcessor.ordering_key(update)
+        if key is None:
+            async with self.running:
+                await coroutine
+            return
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self.running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+    async def initialize(self):
+        pass
+    async def shutdown(self):
+        pass
+
+class RenderCache:
+    # Finished messages and keyboards, stored with the version of the data they were rendered from: a plan's tally version
+    # or a user's plans version. Every write that changes the data changes its version, so a render for an older version is never served.
+    # Callers read the version before the data, a render is then never stored under a version newer than what it shows.
+    max_entries: int = 4096
+    ttl: float = None
+    def __init__(self, max_entries = 4096, ttl = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+    def get(self, key, version):
+        entry = self.entries.get(key)
+        if entry is None or version is None or entry[0] != version:
+            return None
+        if self.ttl is not None and monotonic() - entry[1] > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[2]
+    def put(self, key, version, value):
+        if version is not None:
+            self.entries[key] = (version, monotonic(), value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+class Bot:
+    repo: AsyncRepository = None
     app: Application = None
+    outbound: OutboundScheduler = None
     bot_name = ""
-    user_operations = {}
+    operations: MemoryOperationStore | SqliteOperationStore = None
+    operations_sweep_interval: float = 300
+    fanout_delay: float = 1.0
+    metrics: Metrics = None
+    MESSAGE_LIMIT = 4096
+    RESULTS_PAGE_SIZE = 5
+    RESULTS_NAMES_PER_ANSWER = 100
+    MORE_NAMES_LENGTH = len(" and 999999 more")
+    KNOWN_USERS = 10000
+    # Buttons that do the same thing however often they're pressed, or votes, whose repeated presses are added up
+    SINGLE_FLIGHT = {"v", "sr", "r", "rr"}
+    BEST_OPTIONS = 5
+    BUTTON_HANDLERS = {"m": "manage_plan", "d": "delete_plan_confirmation", "dd": "delete_plan", "q": "start_question_edit", "c": "cancel_operation",
+        "-": "choose_option_to_remove", "--": "remove_option", "+": "start_add_option", "r": "show_results", "rr": "show_extended_results",
+        "rrv": "show_extended_results", "x": "export_results", "b": "show_best_options", "s": "start_poll", "sr": "refresh_poll", "v": "vote", "?": "show_voting_help"}
+    UPDATE_TYPES = ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result")
     @staticmethod
     def answer_to_text(answer):
         match answer:
@@ -259,11 +1565,12 @@ class Bot:
         return InlineKeyboardMarkup(list(map(lambda x: [InlineKeyboardButton(str(x["question"]), callback_data=f"m|{userid}|{int(x['rowid'])}")], plans)))
     @staticmethod
     def make_option_selector_markup(options, planid, userid):
-        def confirmedPeopleNumber(el):
-            return int(el["confirmedPeopleNumber"])
-        def maybePeopleNumber(el):
-            return int(el["maybePeopleNumber"])
-        option_selector_list = list(map(lambda x: [InlineKeyboardButton(f'{str(x["option"])}{f" ✔*{confirmedPeopleNumber(x)}" if confirmedPeopleNumber(x) > 0 else ""}{f" ❔*{maybePeopleNumber(x)}" if maybePeopleNumber(x) > 0 else ""}', callback_data = f"v|{planid}|{x['rowid']}")], options))
+        option_selector_list = []
+        for option in options:
+            confirmed = int(option["confirmedPeopleNumber"])
+            maybe = int(option["maybePeopleNumber"])
+            label = str(option["option"]) + (f" ✔*{confirmed}" if confirmed > 0 else "") + (f" ❔*{maybe}" if maybe > 0 else "")
+            option_selector_list.append([InlineKeyboardButton(label, callback_data = f"v|{planid}|{option['rowid']}")])
         option_selector_list.append(
             [
                 InlineKeyboardButton("❌ End", callback_data = f"rrv|{userid}|{planid}"),
@@ -300,119 +1607,171 @@ class Bot:
                 case _:
                     return f'{option}th'
     async def start_or_manage(self, update: Update, context : ContextTypes.DEFAULT_TYPE):
-        plans = self.repo.get_all_plans(update.effective_user.id)
-        if(len(plans) > 0):
-            markup = Bot.make_plan_list_markup(update.effective_user.id, plans)
-            await context.bot.send_message(update.effective_chat.id, "Select a plan to manage it, or send me /new to create a new one", reply_markup=markup)
+        userid = update.effective_user.id
+        version = self.repo.searches.version(userid)
+        markup = self.list_renders.get(("plans", userid), version)
+        if markup is None:
+            plans = await self.repo.get_all_plans(userid)
+            markup = self.list_renders.put(("plans", userid), version, Bot.make_plan_list_markup(userid, plans) if len(plans) > 0 else False)
+        if(markup):
+            await self.outbound.send(update.effective_chat.id, "Select a plan to manage it, or send me /new to create a new one", reply_markup=markup)
         else:
-            await context.bot.send_message(update.effective_chat.id, "You don't have any plan yet, send me /new to create a new one")
+            await self.outbound.send(update.effective_chat.id, "You don't have any plan yet, send me /new to create a new one")
     async def new_plan(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.user_operations[update.effective_user.id] = f'n|{update.effective_user.id}'
-        await context.bot.send_message(update.effective_chat.id, "Ok, send me the name for the plan")
+        await self.operations.set(update.effective_user.id, UserOperation(UserOperation.NEW_PLAN))
+        await self.outbound.send(update.effective_chat.id, "Ok, send me the name for the plan")
     async def full_help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await context.bot.send_message(update.effective_chat.id, "I can help you select the best possible moment to organize your event, by asking people to choose the options they like and then ones they can work with if necessary.")
-        await context.bot.send_message(update.effective_chat.id, "You can create plans for a new event by sending me the /new command and I'll guide you through the creation.")
-        await context.bot.send_message(update.effective_chat.id, "You can manage your plans by sending me the /manage command. I'll give you a list of all your plans. Choose a plan to change the question, add or remove options, delete the plan or view the current results.")
-        await context.bot.send_message(update.effective_chat.id, f"You don't need to add me to any group chat. You just need to open whatever chat you want to send a poll to and type @{self.bot_name} followed by a space and select the plan you want to send. You can even start typing the question in your plan to filter your plans and select the one you need.")
-        await context.bot.send_message(update.effective_chat.id, "Once you've sent your plan to a person or a group, they'll be able to vote. Each time they click an option they will cycle between the available choices. The default is \"No\", and clicking cycles to \"Yes\", \"If necessary\" and then back to \"No\". They get a little help button that explains how to vote.")
-        await context.bot.send_message(update.effective_chat.id, "You can send each plan to as many chats as you want, but keep in mind that each one is updated separately, so if you want the counters to be up to date you may need to refresh the poll manually with the proper button. Similarly, the end button ends the poll in that specific chat, the poll will keep working in any other chat you sent it until you explicitly end it there.")
+        await self.outbound.send(update.effective_chat.id, "I can help you select the best possible moment to organize your event, by asking people to choose the options they like and then ones they can work with if necessary.")
+        await self.outbound.send(update.effective_chat.id, "You can create plans for a new event by sending me the /new command and I'll guide you through the creation.")
+        await self.outbound.send(update.effective_chat.id, "You can manage your plans by sending me the /manage command. I'll give you a list of all your plans. Choose a plan to change the question, add or remove options, delete the plan or view the current results.")
+        await self.outbound.send(update.effective_chat.id, f"You don't need to add me to any group chat. You just need to open whatever chat you want to send a poll to and type @{self.bot_name} followed by a space and select the plan you want to send. You can even start typing the question in your plan to filter your plans and select the one you need.")
+        await self.outbound.send(update.effective_chat.id, "Once you've sent your plan to a person or a group, they'll be able to vote. Each time they click an option they will cycle between the available choices. The default is \"No\", and clicking cycles to \"Yes\", \"If necessary\" and then back to \"No\". They get a little help button that explains how to vote.")
+        await self.outbound.send(update.effective_chat.id, "You can send each plan to as many chats as you want, and the counters in every chat are kept up to date as people vote. The end button ends the poll in that specific chat, the poll will keep working in any other chat you sent it until you explicitly end it there.")
     async def done_inserting_options(self, update: Update, context: ContextTypes.DEFAULT_TYPE, planid):
-        self.repo.plan_ready(planid)
-        await context.bot.send_message(update.effective_chat.id, f"Great! Your plan is ready! You can now send it to whoever you want by typing @{self.bot_name} and selecting this plan")
+        await self.repo.plan_ready(planid)
+        await self.outbound.send(update.effective_chat.id, f"Great! Your plan is ready! You can now send it to whoever you want by typing @{self.bot_name} and selecting this plan")
     async def done(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        op = self.user_operations.pop(update.effective_user.id, None)
+        op = await self.operations.pop(update.effective_user.id)
         failed_command = False
         if(op):
-            d = op.split('|')
-            match d[0]:
-                case "++":
-                    planid = int(d[1])
-                    await self.done_inserting_options(update, context, planid)
+            match op.kind:
+                case UserOperation.NEW_PLAN_OPTION:
+                    await self.done_inserting_options(update, context, op.planid)
                 case _:
                     failed_command = True
         else:
             failed_command = True
         if(failed_command):
-            await context.bot.send_message("The command /done does nothing right now")
-            self.user_operations[update.effective_user.id] = op
+            await self.outbound.send(update.effective_chat.id, "The command /done does nothing right now")
+            if(op):
+                await self.operations.set(update.effective_user.id, op)
     async def new_plan_title_sent(self, text, update: Update, context: ContextTypes.DEFAULT_TYPE, userid):
-        planid = self.repo.start_plan_creation(text, userid)
-        self.user_operations[update.effective_user.id] = f'++|{planid}|1'
-        await context.bot.send_message(update.effective_chat.id, "Great! Now send me the 1st option, or /done to finish")
+        planid = await self.repo.start_plan_creation(text, userid)
+        await self.operations.set(update.effective_user.id, UserOperation(UserOperation.NEW_PLAN_OPTION, planid, 1))
+        await self.outbound.send(update.effective_chat.id, "Great! Now send me the 1st option, or /done to finish")
     async def new_plan_add_option(self, text, update: Update, context: ContextTypes.DEFAULT_TYPE, planid, option):
-        self.repo.add_option(text, planid)
-        self.user_operations[update.effective_user.id] = f'++|{planid}|{option + 1}'
-        await context.bot.send_message(update.effective_chat.id, f"Ok, now send me the {Bot.get_ordinal(option + 1)}, or /done to finish")
+        await self.repo.add_option(text, planid)
+        await self.operations.set(update.effective_user.id, UserOperation(UserOperation.NEW_PLAN_OPTION, planid, option + 1))
+        await self.outbound.send(update.effective_chat.id, f"Ok, now send me the {Bot.get_ordinal(option + 1)}, or /done to finish")
     async def plaintext(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        op = self.user_operations.pop(update.effective_user.id, None)
+        userid = update.effective_user.id
+        op = await self.operations.pop(userid)
         if(op):
-            d = op.split('|')
-            match d[0]:
-                case "q":
-                    userid = int(d[1])
-                    planid = int(d[2])
-                    await self.edit_question(update.message.text, update, context, userid, planid)
-                case "+":
-                    userid = int(d[1])
-                    planid = int(d[2])
-                    await self.add_option(update.message.text, update, context, planid)
-                case "n":
-                    userid = int(d[1])
+            match op.kind:
+                case UserOperation.EDIT_QUESTION:
+                    await self.edit_question(update.message.text, update, context, userid, op.planid)
+                case UserOperation.ADD_OPTION:
+                    await self.add_option(update.message.text, update, context, op.planid)
+                case UserOperation.NEW_PLAN:
                     await self.new_plan_title_sent(update.message.text, update, context, userid)
-                case "++":
-                    planid = int(d[1])
-                    option = int(d[2])
-                    await self.new_plan_add_option(update.message.text, update, context, planid, option)
+                case UserOperation.NEW_PLAN_OPTION:
+                    await self.new_plan_add_option(update.message.text, update, context, op.planid, op.option)
         else:
-            await context.bot.send_message(update.effective_chat.id, "I'm sorry, I don't know what you mean")
+            await self.outbound.send(update.effective_chat.id, "I'm sorry, I don't know what you mean")
 
     async def inline(self, update: Update, context : ContextTypes.DEFAULT_TYPE):
         query = update.inline_query.query
         userid = update.inline_query.from_user.id
-        plans = self.repo.get_all_plans_filtered(userid, query.strip(), 10)
-        results = Bot.make_plan_list_expandable_inline_markup(plans)
-        await context.bot.answer_inline_query(update.inline_query.id, results, switch_pm_text="Manage your plans or create a new one", switch_pm_parameter="manage", cache_time=0)
-    async def start_poll(self, query: CallbackQuery, planid, refreshGuard = False):
-        # refreshGuard accounts for the fact that I can't edit a message without changing it.
-        # Since checking for changes would require a significant amount of restructuring, I'm just gonna edit it twice.
-        # This has the nice bonus of implicitly managing users being impatient and clicking repeatedly.
-        if(refreshGuard):
-            await query.edit_message_text("🔄 Refreshing...")
-            await sleep(0.5)
-        plan = self.repo.get_plan(planid)
-        plan_options = self.repo.get_plan_options_with_results(planid)
-        option_selector = Bot.make_option_selector_markup(plan_options, planid, int(plan["creatorUserId"]))
-        await query.edit_message_text(f"{plan['question']}", reply_markup=option_selector)
+        version = self.repo.searches.version(userid)
+        results = self.list_renders.get(("inline", userid, query.strip()), version)
+        if results is None:
+            plans = await self.repo.get_all_plans_filtered(userid, query.strip(), 10)
+            results = self.list_renders.put(("inline", userid, query.strip()), version, Bot.make_plan_list_expandable_inline_markup(plans))
+        button = InlineQueryResultsButton("Manage your plans or create a new one", start_parameter="manage")
+        # Results are personal and our own cache is invalidated on every change, so Telegram only gets to keep them for a few seconds
+        await self.outbound.answer_inline(update.inline_query.id, results, button=button, cache_time=5, is_personal=True)
+    async def chosen_plan(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        result = update.chosen_inline_result
+        if result.inline_message_id:
+            await self.repo.add_posted_message(int(result.result_id), result.inline_message_id)
+    async def render_poll(self, planid):
+        # A plan whose tallies are cached and didn't change since the last render costs no database call at all
+        version = self.repo.tallies.version(planid)
+        rendered = self.poll_renders.get(planid, version)
+        if rendered is not None:
+            return rendered
+        plan = await self.repo.get_plan(planid)
+        if plan is None:
+            return None
+        plan_options = await self.repo.get_plan_options_with_results(planid)
+        return self.poll_renders.put(planid, version, (f"{plan['question']}", Bot.make_option_selector_markup(plan_options, planid, int(plan["creatorUserId"]))))
+    def schedule_fanout(self, planid):
+        if planid in self.fanout_pending:
+            return
+        self.fanout_pending.add(planid)
+        # Kept here rather than started by the application, which doesn't wait for tasks started once it's stopping,
+        # as it is while it still handles the last updates it received
+        task = create_task(self.fanout(planid))
+        self.fanout_tasks.add(task)
+        task.add_done_callback(self.fanout_tasks.discard)
+    async def fanout(self, planid):
+        # Changes landing while we wait are folded into this pass, so a burst of votes costs one edit per posted message
+        try:
+            await sleep(self.fanout_delay)
+        finally:
+            self.fanout_pending.discard(planid)
+        rendered = await self.render_poll(planid)
+        if rendered is None:
+            return
+        text, markup = rendered
+        for inline_message_id in await self.repo.get_posted_messages(planid):
+            # Edits are rate limited, a copy may have been ended with the results while earlier ones were sent
+            if not await self.repo.is_posted_message(inline_message_id):
+                continue
+            try:
+                await self.outbound.edit_inline(inline_message_id, text, markup)
+            except BadRequest:
+                await self.repo.remove_posted_message(inline_message_id)
+            except TelegramError as e:
+                print(f"Updating posted message {inline_message_id} failed: {e}")
+    async def start_poll(self, query: CallbackQuery, planid, refresh = False):
+        if query.inline_message_id:
+            await self.repo.add_posted_message(planid, query.inline_message_id)
+        rendered = await self.render_poll(planid)
+        if rendered is None:
+            await self.outbound.edit(query, "This plan doesn't exist anymore")
+            return
+        text, option_selector = rendered
+        changed = await self.outbound.edit(query, text, reply_markup=option_selector)
+        if(refresh and changed is False):
+            await self.outbound.answer(query, "Already up to date")
     async def show_voting_help(self, query: CallbackQuery):
-        await query.answer("""Click an option to cycle your answer. The default answer is "No" and the cycle is "Yes" ➡ "If necessary" ➡ "No". 
+        await self.outbound.answer(query, """Click an option to cycle your answer. The default answer is "No" and the cycle is "Yes" ➡ "If necessary" ➡ "No". 
 A popup will state your choice when you click an option.
 Refresh updates everything.""", show_alert=True)
-    async def vote(self, query: CallbackQuery, planid, optionid):
+    async def vote(self, query: CallbackQuery, planid, optionid, flight = None):
         userid = query.from_user.id
         username = query.from_user.name
-        current_vote = self.repo.get_current_vote(optionid, userid)
-        option = self.repo.get_option_name(optionid)
-        if current_vote is None:
-            new_vote = Repository.ANSWER_YES
-            self.repo.insert_vote(optionid, userid, username, new_vote)
-        else:
-            match current_vote:
-                case Repository.ANSWER_YES:
-                    new_vote = Repository.ANSWER_IF_NECESSARY
-                case Repository.ANSWER_IF_NECESSARY:
-                    new_vote = Repository.ANSWER_NO
-                case Repository.ANSWER_NO:
-                    new_vote = Repository.ANSWER_YES
-                case _:
-                    new_vote = Repository.ANSWER_YES
-            self.repo.update_vote(optionid, userid, new_vote)
-        plan = self.repo.get_plan(planid)
-        plan_options = self.repo.get_plan_options_with_results(planid)
-        option_selector = Bot.make_option_selector_markup(plan_options, planid, int(plan["creatorUserId"]))
-        await query.answer(f"You answered {Bot.answer_to_text(new_vote)} to {option}")
-        await query.edit_message_text(f"{plan['question']}", reply_markup=option_selector)
+        # Presses that joined this one go into the same write, those joining while it's written into one more.
+        # Only the net clicks are written, three presses leave the answer as it was.
+        steps = 1 + self.flights.take(flight)
+        result = await self.repo.cycle_vote(optionid, userid, username, steps % 3 or 3)
+        # Presses joining after this start a new flight, which waits for this one to finish
+        self.flights.close(flight)
+        steps = self.flights.take(flight)
+        if result is not None and steps % 3:
+            result = await self.repo.cycle_vote(optionid, userid, username, steps % 3)
+        if result is None:
+            self.flights.land(flight, "This option doesn't exist anymore, try refreshing the poll")
+            await self.outbound.answer(query, "This option doesn't exist anymore, try refreshing the poll")
+            return
+        answer = f"You answered {Bot.answer_to_text(result['answer'])} to {result['option']}"
+        self.flights.land(flight, answer)
+        plan = result["plan"]
+        rendered = self.poll_renders.get(planid, result["version"])
+        if rendered is None:
+            rendered = self.poll_renders.put(planid, result["version"], (f"{plan['question']}", Bot.make_option_selector_markup(result["options"], planid, int(plan["creatorUserId"]))))
+        text, option_selector = rendered
+        await self.outbound.answer(query, answer)
+        await self.outbound.edit(query, text, reply_markup=option_selector)
+        self.schedule_fanout(planid)
     async def inline_button(self, update: Update, context: CallbackContext):
         query = update.callback_query
+        flight = self.flights.get(update)
+        if flight is not None and flight["leader"] != update.update_id:
+            # A repeated press, answered like the one it joined, which does the work and the edit
+            await self.outbound.answer(query, await flight["answer"])
+            return
         d = str(query.data).split('|')
         match d[0]:
             case "m":
@@ -452,26 +1811,35 @@ Refresh updates everything.""", show_alert=True)
             case "rr":
                 userid = int(d[1])
                 planid = int(d[2])
-                await self.show_extended_results(query, userid, planid)
+                page = int(d[3]) if len(d) > 3 else 0
+                await self.show_extended_results(query, userid, planid, page)
             case "rrv":
                 userid = int(d[1])
                 planid = int(d[2])
-                await self.show_extended_results(query, userid, planid)
+                await self.show_extended_results(query, userid, planid, end_poll=True)
+            case "x":
+                userid = int(d[1])
+                planid = int(d[2])
+                await self.export_results(query, userid, planid)
+            case "b":
+                userid = int(d[1])
+                planid = int(d[2])
+                await self.show_best_options(query, userid, planid)
             case "s":
                 planid = int(d[1])
                 await self.start_poll(query, planid)
             case "sr":
                 planid = int(d[1])
-                await self.start_poll(query, planid, refreshGuard=True)
+                await self.start_poll(query, planid, refresh=True)
             case "v":
                 planid = int(d[1])
                 optionid = int(d[2])
-                await self.vote(query, planid, optionid)
+                await self.vote(query, planid, optionid, flight)
             case "?":
                 await self.show_voting_help(query)
             case _:
-                await query.edit_message_text("We're sorry, there was an error processing your button press")
-        await query.answer()
+                await self.outbound.edit(query, "We're sorry, there was an error processing your button press")
+        await self.outbound.answer(query)
     async def manage_plan(self, query: CallbackQuery, userid, planid):
         reply_markup = InlineKeyboardMarkup(
             [
@@ -485,100 +1853,437 @@ Refresh updates everything.""", show_alert=True)
                 ],
                 [InlineKeyboardButton("ℹ️ Show results", callback_data=f"r|{userid}|{planid}")]
             ])
-        plan = self.repo.get_plan(planid)
-        await query.edit_message_text(f'Editing "{plan["question"]}"', reply_markup=reply_markup)
+        plan = await self.repo.get_plan(planid)
+        await self.outbound.edit(query, f'Editing "{plan["question"]}"', reply_markup=reply_markup)
     async def show_results(self, query: CallbackQuery, userid, planid):
-        plan = self.repo.get_plan(planid)
-        results = self.repo.get_answers_formatted(planid)
+        plan = await self.repo.get_plan(planid)
+        results = await self.repo.get_answers_formatted(planid)
         final_message = f'Here are the results for "{plan["question"]}":'
         for result in results:
             final_message += f'\n{result["option"]}: {"✔" * result["confirmedPeopleNumber"]}{"❔" * result["maybePeopleNumber"]}{"None" if result["confirmedPeopleNumber"] + result["maybePeopleNumber"] == 0 else ""}'
-        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("➕ More info", callback_data=f'rr|{userid}|{planid}')]])
-        await query.edit_message_text(final_message, reply_markup=reply_markup)
-    async def show_extended_results(self, query: CallbackQuery, userid, planid):
-        plan = self.repo.get_plan(planid)
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("➕ More info", callback_data=f'rr|{userid}|{planid}'), InlineKeyboardButton("🏆 Best options", callback_data=f'b|{userid}|{planid}')]])
+        await self.outbound.edit(query, final_message, reply_markup=reply_markup)
+    async def show_best_options(self, query: CallbackQuery, userid, planid):
+        plan = await self.repo.get_plan(planid)
+        if plan is None:
+            await self.outbound.edit(query, "This plan doesn't exist anymore")
+            return
+        options = await self.repo.get_best_options(planid, Bot.BEST_OPTIONS)
+        final_message = f'🏆 Best options for "{plan["question"]}":'
+        for position, option in enumerate(options, 1):
+            final_message += f'\n{position}. {option["option"]}: ✔ {option["confirmedPeopleNumber"]} ❔ {option["maybePeopleNumber"]} (score {option["score"]:g})'
+        if not options:
+            final_message += "\nNo one answered yet"
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("ℹ️ Show results", callback_data=f"r|{userid}|{planid}")]])
+        await self.outbound.edit(query, final_message[:Bot.MESSAGE_LIMIT], reply_markup=reply_markup)
+    @staticmethod
+    def join_names(names, total, budget):
+        # As many names as fit in budget characters, the full list is in the CSV export
+        if len(names) == total and len(", ".join(names)) <= budget:
+            return ", ".join(names)
+        budget -= Bot.MORE_NAMES_LENGTH
+        shown = []
+        for name in names:
+            budget -= len(name) + 2
+            if budget < 0:
+                break
+            shown.append(name)
+        if not shown:
+            return f"{total} people"
+        return f"{', '.join(shown)} and {total - len(shown)} more"
+    @staticmethod
+    def share_budget(lengths, budget):
+        # Lists needing less than an even share leave the rest to the longer ones
+        shares = [0] * len(lengths)
+        pending = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        while pending:
+            i = pending.pop(0)
+            shares[i] = min(lengths[i], budget // (len(pending) + 1))
+            budget -= shares[i]
+        return shares
+    @staticmethod
+    def format_extended_result(option, confirmed, maybe):
+        return f'\n\n{option}:\n- {"No one" if confirmed is None else "✔ " + confirmed} confirmed their availability for this day\n- {"No one" if maybe is None else "❔ " + maybe} said they may be available for this day if strictly necessary'
+    async def show_extended_results(self, query: CallbackQuery, userid, planid, page = 0, end_poll = False):
+        plan = await self.repo.get_plan(planid)
         pressing_user_id = query.from_user.id
         if(userid != pressing_user_id):
-            await query.answer("Only the creator of this plan can end the poll", show_alert=True)
+            await self.outbound.answer(query, "Only the creator of this plan can end the poll" if end_poll else "Only the creator of this plan can browse the detailed results", show_alert=True)
             return
-        results = self.repo.get_answers_formatted(planid)
-        final_message = f'Here are the results for "{plan["question"]}":'
-        for result in results:
-            final_message += f'\n\n{result["option"]}:\n- {"✔ " + result["confirmedPeople"] if result["confirmedPeopleNumber"] > 0 else "No one"} confirmed their availability for this day\n- {"❔ " + result["maybePeople"] if result["maybePeopleNumber"] > 0 else "No one"} said they may be available for this day if strictly necessary'
-        await query.edit_message_text(final_message)
+        if plan is None:
+            await self.outbound.edit(query, "This plan doesn't exist anymore")
+            return
+        if end_poll and query.inline_message_id:
+            await self.repo.remove_posted_message(query.inline_message_id)
+        results, options_count, page = await self.repo.get_results_page(planid, page, Bot.RESULTS_PAGE_SIZE, Bot.RESULTS_NAMES_PER_ANSWER)
+        pages = max(1, -(-options_count // Bot.RESULTS_PAGE_SIZE))
+        final_message = f'Here are the results for "{plan["question"]}"' + (f' (page {page + 1} of {pages})' if pages > 1 else '') + ':'
+        # Names get whatever is left of Telegram's message limit once the rest of the text is in
+        lists = [(result[names], result[f"{names}Number"]) for result in results for names in ("confirmedPeople", "maybePeople")]
+        fixed = len(final_message) + sum(len(Bot.format_extended_result(result["option"], "" if result["confirmedPeopleNumber"] else None, "" if result["maybePeopleNumber"] else None)) for result in results)
+        shares = Bot.share_budget([len(", ".join(names)) + (Bot.MORE_NAMES_LENGTH if len(names) < total else 0) for names, total in lists], Bot.MESSAGE_LIMIT - fixed)
+        texts = [Bot.join_names(names, total, share) if total > 0 else None for (names, total), share in zip(lists, shares)]
+        for index, result in enumerate(results):
+            final_message += Bot.format_extended_result(result["option"], texts[2 * index], texts[2 * index + 1])
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("◀ Previous", callback_data=f"rr|{userid}|{planid}|{page - 1}"))
+        if page + 1 < pages:
+            navigation.append(InlineKeyboardButton("Next ▶", callback_data=f"rr|{userid}|{planid}|{page + 1}"))
+        buttons = [[InlineKeyboardButton("📄 Export CSV", callback_data=f"x|{userid}|{planid}")]]
+        if navigation:
+            buttons.insert(0, navigation)
+        await self.outbound.edit(query, final_message[:Bot.MESSAGE_LIMIT], reply_markup=InlineKeyboardMarkup(buttons))
+    async def export_results(self, query: CallbackQuery, userid, planid):
+        if(userid != query.from_user.id):
+            await self.outbound.answer(query, "Only the creator of this plan can export the results", show_alert=True)
+            return
+        plan = await self.repo.get_plan(planid)
+        if plan is None:
+            await self.outbound.answer(query, "This plan doesn't exist anymore")
+            return
+        # The export goes to the creator's private chat, the results may be shown in a group through an inline message.
+        # Past the first megabyte the file is spooled to disk.
+        with SpooledTemporaryFile(max_size=1024 * 1024) as file:
+            await self.repo.export_answers(planid, file, Bot.answer_to_text)
+            await self.outbound.send_document(userid, file, f"plan-{planid}.csv", caption=f'Answers to "{plan["question"]}"'[:1024])
+        if query.inline_message_id:
+            await self.outbound.answer(query, "I sent you the results in a private chat")
     async def start_add_option(self, query: CallbackQuery, userid, planid):
-        self.user_operations[userid] = f"+|{userid}|{planid}"
-        plan = self.repo.get_plan(planid)
+        await self.operations.set(userid, UserOperation(UserOperation.ADD_OPTION, planid))
+        plan = await self.repo.get_plan(planid)
         reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="c")]])
-        await query.edit_message_text(f'Ok, send me the new option for "{plan["question"]}"', reply_markup=reply_markup)
+        await self.outbound.edit(query, f'Ok, send me the new option for "{plan["question"]}"', reply_markup=reply_markup)
     async def add_option(self, text, update: Update, context: ContextTypes.DEFAULT_TYPE, planid):
-        self.repo.add_option(text, planid)
-        await context.bot.send_message(update.effective_chat.id, "Option added")
+        await self.repo.add_option(text, planid)
+        self.schedule_fanout(planid)
+        await self.outbound.send(update.effective_chat.id, "Option added")
     async def remove_option(self, query: CallbackQuery, planid, optionid):
-        self.repo.remove_option(planid, optionid)
-        await query.edit_message_text("Option removed")
+        await self.repo.remove_option(planid, optionid)
+        self.schedule_fanout(planid)
+        await self.outbound.edit(query, "Option removed")
     async def choose_option_to_remove(self, query: CallbackQuery, userid, planid):
-        plan = self.repo.get_plan(planid)
+        plan = await self.repo.get_plan(planid)
         if(plan):
-            options = self.repo.get_all_options(planid)
+            options = await self.repo.get_all_options(planid)
             markup_content = list(map(lambda x: [InlineKeyboardButton(f"➖ {x['option']}", callback_data=f"--|{planid}|{x['rowid']}")], options))
             markup_content.append([InlineKeyboardButton("❌ Cancel", callback_data="c")])
             reply_markup = InlineKeyboardMarkup(markup_content)
-            await query.edit_message_text("What option do you want to remove?", reply_markup=reply_markup)
+            await self.outbound.edit(query, "What option do you want to remove?", reply_markup=reply_markup)
     async def start_question_edit(self, query: CallbackQuery, userid, planid):
-        self.user_operations[userid] = f"q|{userid}|{planid}"
-        plan = self.repo.get_plan(planid)
+        await self.operations.set(userid, UserOperation(UserOperation.EDIT_QUESTION, planid))
+        plan = await self.repo.get_plan(planid)
         reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="c")]])
-        await query.edit_message_text(f'Ok, send me the new title for "{plan["question"]}"', reply_markup=reply_markup)
+        await self.outbound.edit(query, f'Ok, send me the new title for "{plan["question"]}"', reply_markup=reply_markup)
     async def edit_question(self, text, update: Update, context: ContextTypes.DEFAULT_TYPE, userid, planid):
-        self.repo.update_plan_title(text, userid, planid)
-        await context.bot.send_message(update.effective_chat.id, "Title changed")
+        await self.repo.update_plan_title(text, userid, planid)
+        self.schedule_fanout(planid)
+        await self.outbound.send(update.effective_chat.id, "Title changed")
     async def delete_plan_confirmation(self, query: CallbackQuery, userid, planid):
         reply_markup = InlineKeyboardMarkup([[
             InlineKeyboardButton("✅ Yes", callback_data=f"dd|{userid}|{planid}"),
             InlineKeyboardButton("❌ No", callback_data="c")
         ]])
-        plan = self.repo.get_plan(planid)
-        await query.edit_message_text(f'Really delete "{plan["question"]}"?', reply_markup=reply_markup)
+        plan = await self.repo.get_plan(planid)
+        await self.outbound.edit(query, f'Really delete "{plan["question"]}"?', reply_markup=reply_markup)
     async def cancel_operation(self, query: CallbackQuery):
-        self.user_operations.pop(query.from_user.id, None)
-        await query.edit_message_text("Ok, nevermind")
+        await self.operations.pop(query.from_user.id)
+        await self.outbound.edit(query, "Ok, nevermind")
     async def delete_plan(self, query: CallbackQuery, userid, planid):
-        plan = self.repo.get_plan(planid)
-        self.repo.delete_plan(userid, planid)
-        await query.edit_message_text(f'Plan "{plan["question"]}" deleted')
-    def __init__(self, token, repository, bot_name):
+        plan = await self.repo.get_plan(planid)
+        await self.repo.delete_plan(userid, planid)
+        await self.outbound.edit(query, f'Plan "{plan["question"]}" deleted')
+    def __init__(self, token, repository, bot_name, fanout_delay = 1.0, global_rate = 30.0, chat_rate = 1.0, chat_burst = 5, base_url = None, concurrent_updates = 32, operations = None, operations_sweep_interval = 300, receive_updates = True,
+            metrics_host = "127.0.0.1", metrics_port = None, maintenance_interval = None, draft_max_age = 7 * 24 * 3600, render_cache_size = 4096, prewarm_plans = 0, prewarm_filter = None):
         self.repo = repository
-        self.app = ApplicationBuilder().token(token).build()
-        start_h = CommandHandler('start', self.start_or_manage)
+        self.poll_renders = RenderCache(render_cache_size)
+        # Plan lists go by the search cache versions, and expire with it as a safety net
+        self.list_renders = RenderCache(render_cache_size, repository.searches.ttl)
+        # Names users were last seen with, so a name is only written when it changed
+        self.user_names = OrderedDict()
+        self.maintenance_interval = maintenance_interval
+        self.draft_max_age = draft_max_age
+        self.metrics = repository.metrics
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.operations = operations or MemoryOperationStore()
+        self.operations_sweep_interval = operations_sweep_interval
+        self.fanout_delay = fanout_delay
+        self.fanout_pending = set()
+        self.fanout_tasks = set()
+        self.prewarm_plans = prewarm_plans
+        self.prewarm_filter = prewarm_filter
+        builder = ApplicationBuilder().token(token).post_init(self.post_init).post_stop(self.post_stop).post_shutdown(self.post_shutdown)
+        self.flights = PressFlights(Bot.SINGLE_FLIGHT)
+        builder = builder.concurrent_updates(OrderedUpdateProcessor(concurrent_updates, flights=self.flights))
+        if not receive_updates:
+            builder = builder.updater(None)
+        if base_url:
+            builder = builder.base_url(base_url)
+        self.app = builder.build()
+        self.outbound = OutboundScheduler(self.app.bot, global_rate, chat_rate, chat_burst, metrics=self.metrics)
+        count_h = TypeHandler(Update, self.count_update)
+        self.app.add_handler(count_h, group=-1)
+        rename_h = TypeHandler(Update, self.rename_user)
+        self.app.add_handler(rename_h, group=-2)
+        start_h = CommandHandler('start', self.instrumented('start', self.start_or_manage))
         self.app.add_handler(start_h)
-        manage_h = CommandHandler('manage', self.start_or_manage)
+        manage_h = CommandHandler('manage', self.instrumented('manage', self.start_or_manage))
         self.app.add_handler(manage_h)
-        new_h = CommandHandler('new', self.new_plan)
+        new_h = CommandHandler('new', self.instrumented('new_plan', self.new_plan))
         self.app.add_handler(new_h)
-        done_h = CommandHandler('done', self.done)
+        done_h = CommandHandler('done', self.instrumented('done', self.done))
         self.app.add_handler(done_h)
-        help_h = CommandHandler('help', self.full_help)
+        help_h = CommandHandler('help', self.instrumented('full_help', self.full_help))
         self.app.add_handler(help_h)
-        inline_h = InlineQueryHandler(self.inline)
+        inline_h = InlineQueryHandler(self.instrumented('inline', self.inline))
         self.app.add_handler(inline_h)
-        inline_b = CallbackQueryHandler(self.inline_button)
+        chosen_h = ChosenInlineResultHandler(self.instrumented('chosen_plan', self.chosen_plan))
+        self.app.add_handler(chosen_h)
+        inline_b = CallbackQueryHandler(self.instrumented(Bot.button_handler, self.inline_button))
         self.app.add_handler(inline_b)
-        plaintext_h = MessageHandler(filters.TEXT, callback=self.plaintext)
+        plaintext_h = MessageHandler(filters.TEXT, callback=self.instrumented('plaintext', self.plaintext))
         self.app.add_handler(plaintext_h)
         self.bot_name = bot_name
+    def instrumented(self, name, callback):
+        # name is either the handler's name or a function giving it for an update
+        async def handler(update: Update, context: CallbackContext):
+            with self.metrics.timer("bot_handler_seconds", "bot_handler_errors_total", handler=name(update) if callable(name) else name):
+                await callback(update, context)
+        return handler
+    @staticmethod
+    def button_handler(update: Update):
+        return Bot.BUTTON_HANDLERS.get(str(update.callback_query.data).split('|')[0], "unknown_button")
+    async def count_update(self, update: Update, context: CallbackContext):
+        self.metrics.inc("bot_updates_total", type=next((t for t in Bot.UPDATE_TYPES if getattr(update, t)), "other"))
+    async def rename_user(self, update: Update, context: CallbackContext):
+        user = update.effective_user
+        if user is None or self.user_names.get(user.id) == user.name:
+            return
+        self.user_names[user.id] = user.name
+        self.user_names.move_to_end(user.id)
+        if len(self.user_names) > Bot.KNOWN_USERS:
+            self.user_names.popitem(last=False)
+        # Votes store the name along with the answer
+        if update.callback_query and str(update.callback_query.data).startswith("v|"):
+            return
+        await self.repo.rename_user(user.id, user.name)
+    async def post_init(self, app: Application):
+        self.outbound.start()
+        if self.metrics_port is not None:
+            await self.metrics.start_server(self.metrics_host, self.metrics_port)
+        app.job_queue.run_repeating(self.sweep_operations, interval=self.operations_sweep_interval, first=self.operations_sweep_interval)
+        if self.maintenance_interval:
+            app.job_queue.run_repeating(self.maintain, interval=self.maintenance_interval, first=60)
+        if self.prewarm_plans:
+            # As a job it only starts once updates are being received, so it never delays them
+            app.job_queue.run_once(self.prewarm, 0)
+    async def prewarm(self, context: CallbackContext):
+        # Loads and renders the polls posted most recently, the ones likely to get votes right after a restart
+        started = monotonic()
+        planids = await self.repo.get_recently_posted_plans(self.prewarm_plans)
+        if self.prewarm_filter:
+            planids = list(filter(self.prewarm_filter, planids))
+        for planid in planids:
+            await self.render_poll(planid)
+        print(f"Prewarmed {len(planids)} polls in {(monotonic() - started) * 1000:.0f} ms")
+    async def sweep_operations(self, context: CallbackContext):
+        await self.operations.sweep()
+    async def maintain(self, context: CallbackContext):
+        stats = await self.repo.collect_garbage(datetime.now(tz=timezone.utc) - timedelta(seconds=self.draft_max_age))
+        reclaimed = stats.pop("reclaimedBytes")
+        for kind, count in stats.items():
+            self.metrics.inc("db_maintenance_deleted_total", count, kind=kind)
+        self.metrics.inc("db_maintenance_reclaimed_bytes_total", reclaimed)
+        print(f"Maintenance: deleted {', '.join(f'{count} {kind}' for kind, count in stats.items())}, reclaimed {reclaimed} bytes")
+    async def post_stop(self, app: Application):
+        if self.fanout_tasks:
+            await asyncio.wait(self.fanout_tasks)
+        await self.outbound.stop()
+        await self.metrics.stop_server()
+    async def post_shutdown(self, app: Application):
+        self.repo.close()
+    def start(self):
+        self.app.run_polling()
+        return self.app
+    async def serve_shard(self, inbox):
+        # Worker side of the multi-worker mode, updates come from the ShardRouter instead of Telegram
+        await self.app.initialize()
+        await self.post_init(self.app)
+        await self.app.start()
+        loop = get_running_loop()
+        while True:
+            message = await loop.run_in_executor(None, inbox.get)
+            if message is None:
+                break
+            kind, payload = message
+            match kind:
+                case "update":
+                    await self.app.update_queue.put(Update.de_json(payload, self.app.bot))
+                case "invalidate":
+                    self.repo.repo.forget_plan(payload)
+        await self.app.stop()
+        await self.post_stop(self.app)
+        await self.app.shutdown()
+        await self.post_shutdown(self.app)
+    def start_webhook(self, listen, port, url_path, webhook_url = None, secret_token = None):
+        # On shutdown the HTTP server stops accepting updates first, then updates already received are processed,
+        # pending fan-out tasks finish and the outbound queue drains before the bot disconnects.
+        self.app.run_webhook(listen=listen, port=port, url_path=url_path, webhook_url=webhook_url, secret_token=secret_token)
+        return self.app
+
+class ShardRouter:
+    # Front process of the multi-worker mode: receives updates and hands each one to a worker picked by a stable hash,
+    # so everything that needs ordering or shares in-memory caches always lands on the same worker.
+    app: Application = None
+    def __init__(self, token, inboxes, base_url = None):
+        self.inboxes = inboxes
+        builder = ApplicationBuilder().token(token).post_stop(self.post_stop)
+        if base_url:
+            builder = builder.base_url(base_url)
+        self.app = builder.build()
+        self.app.add_handler(TypeHandler(Update, self.route))
+    @staticmethod
+    def shard_key(update: Update):
+        # Plan callbacks go by plan so votes and fan-out coalescing for a plan stay on one worker, everything else goes by user
+        if update.callback_query:
+            d = str(update.callback_query.data).split('|')
+            if d[0] in ("v", "sr", "s") and len(d) > 1:
+                return f"p|{d[1]}"
+        if update.effective_user:
+            return f"u|{update.effective_user.id}"
+        return f"i|{update.update_id}"
+    @staticmethod
+    def shard_of(key, count):
+        return zlib.crc32(key.encode()) % count
+    def shard(self, update: Update):
+        return ShardRouter.shard_of(ShardRouter.shard_key(update), len(self.inboxes))
+    async def route(self, update: Update, context: CallbackContext):
+        self.inboxes[self.shard(update)].put(("update", update.to_dict()))
+    async def post_stop(self, app: Application):
+        for inbox in self.inboxes:
+            inbox.put(None)
     def start(self):
         self.app.run_polling()
         return self.app
+    def start_webhook(self, listen, port, url_path, webhook_url = None, secret_token = None):
+        self.app.run_webhook(listen=listen, port=port, url_path=url_path, webhook_url=webhook_url, secret_token=secret_token)
+        return self.app
+
+
+def relay_invalidations(invalidations, inboxes):
+    # Plans changed on one worker may be cached by the worker owning their votes, tell every other worker to drop them
+    while True:
+        message = invalidations.get()
+        if message is None:
+            return
+        origin, planid = message
+        for index, inbox in enumerate(inboxes):
+            if index != origin:
+                inbox.put(("invalidate", planid))
+
+
+def build_repository(args):
+    return Repository(args.dbname, pool_size=args.db_pool_size, synchronous=args.db_synchronous, cached_statements=args.db_statement_cache,
+        tally_cache_plans=args.tally_cache_plans, tally_cache_options=args.tally_cache_options, search_cache_ttl=args.search_cache_ttl,
+        vote_buffer_delay=args.vote_buffer_ms / 1000 if args.vote_buffer_ms else None, vote_buffer_size=args.vote_buffer_size)
+
+
+def build_bot(args, repository, receive_updates = True, metrics_port = None, maintenance = True, prewarm_filter = None):
+    slow_query_threshold = args.slow_query_ms / 1000 if args.slow_query_ms is not None else None
+    async_repository = AsyncRepository(repository, metrics=Metrics(), slow_query_threshold=slow_query_threshold)
+    if args.operation_store == "sqlite":
+        operations = SqliteOperationStore(async_repository, args.operation_ttl)
+    else:
+        operations = MemoryOperationStore(args.operation_ttl)
+    # Workers share Telegram's global limit
+    return Bot(token=args.token, repository=async_repository, bot_name=args.botname, fanout_delay=args.fanout_delay,
+        global_rate=args.global_rate / args.workers, chat_rate=args.chat_rate, chat_burst=args.chat_burst, base_url=args.api_base_url,
+        concurrent_updates=args.concurrent_updates, operations=operations, receive_updates=receive_updates, metrics_host=args.metrics_host, metrics_port=metrics_port,
+        maintenance_interval=args.maintenance_interval if maintenance else None, draft_max_age=args.draft_max_age, render_cache_size=args.render_cache_size,
+        prewarm_plans=args.prewarm_plans, prewarm_filter=prewarm_filter)
+
+
+def run_worker(index, args, inbox, invalidations):
+    # The front process decides when workers stop, by sending them None once it stopped receiving updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    repository = build_repository(args)
+    repository.plan_listeners.append(lambda planid: invalidations.put((index, planid)))
+    # Every worker has its own counters, so each one is scraped on its own port
+    # Maintenance works on the shared database, one worker is enough
+    # Each worker only prewarms the plans whose votes are routed to it
+    bot = build_bot(args, repository, receive_updates=False, metrics_port=args.metrics_port + index if args.metrics_port is not None else None, maintenance=index == 0,
+        prewarm_filter=lambda planid: ShardRouter.shard_of(f"p|{planid}", args.workers) == index)
+    asyncio.run(bot.serve_shard(inbox))
+
 
 if __name__ == '__main__':
-    token = sys.argv[1]
-    dbname = sys.argv[2] if len(sys.argv) > 2 else "data.db"
-    botname = sys.argv[3] if len(sys.argv) > 3 else "WorksForMeBot"
-    repository = Repository(dbname)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("token")
+    parser.add_argument("dbname", nargs="?", default="data.db")
+    parser.add_argument("botname", nargs="?", default="WorksForMeBot")
+    parser.add_argument("--db-pool-size", type=int, default=4)
+    parser.add_argument("--db-synchronous", choices=["OFF", "NORMAL", "FULL", "EXTRA"], default="NORMAL")
+    parser.add_argument("--db-statement-cache", type=int, default=128)
+    parser.add_argument("--db-vacuum", action="store_true", help="Rewrite a database created without incremental vacuum so maintenance can shrink it, needs as much free disk space as the database takes")
+    parser.add_argument("--tally-cache-plans", type=int, default=1024)
+    parser.add_argument("--tally-cache-options", type=int, default=65536)
+    parser.add_argument("--search-cache-ttl", type=float, default=15.0)
+    parser.add_argument("--render-cache-size", type=int, default=4096)
+    parser.add_argument("--vote-buffer-ms", type=float, default=None, help="Commit votes in batches at most this old, a crash loses up to this many milliseconds of votes")
+    parser.add_argument("--vote-buffer-size", type=int, default=256, help="With --vote-buffer-ms, most votes waiting to be committed")
+    parser.add_argument("--maybe-weight", type=float, default=None, help="How much an \"If necessary\" counts towards an option's score, a \"Yes\" counts 1. Kept in the database, 0.5 unless changed")
+    parser.add_argument("--fanout-delay", type=float, default=1.0)
+    parser.add_argument("--global-rate", type=float, default=30.0)
+    parser.add_argument("--chat-rate", type=float, default=1.0)
+    parser.add_argument("--chat-burst", type=int, default=5)
+    parser.add_argument("--api-base-url", default=None)
+    parser.add_argument("--concurrent-updates", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--operation-store", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument("--operation-ttl", type=float, default=3600)
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    parser.add_argument("--webhook-listen", default="0.0.0.0")
+    parser.add_argument("--webhook-port", type=int, default=8443)
+    parser.add_argument("--webhook-path", default="")
+    parser.add_argument("--webhook-url", default=None)
+    parser.add_argument("--webhook-secret", default=None)
+    parser.add_argument("--metrics-host", default="127.0.0.1")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve Prometheus metrics on /metrics, with --workers worker n uses this port + n")
+    parser.add_argument("--slow-query-ms", type=float, default=None, help="Log repository calls slower than this")
+    parser.add_argument("--maintenance-interval", type=float, default=6 * 3600, help="Seconds between database maintenance runs, 0 disables them")
+    parser.add_argument("--draft-max-age", type=float, default=7 * 24 * 3600, help="Seconds after which plans never finished with /done are deleted")
+    parser.add_argument("--prewarm-plans", type=int, default=0, help="After starting, load the polls of this many recently posted plans into the caches")
+    args = parser.parse_args()
+    repository = build_repository(args)
     try:
-        repository.create_database()
+        repository.create_database(vacuum=args.db_vacuum)
+        if args.maybe_weight is not None:
+            repository.set_maybe_weight(args.maybe_weight)
     except Error as e:
         print(e)
         sys.exit(1)
-    bot = Bot(token=token, repository=repository, bot_name=botname).start()
\ No newline at end of file
+    if args.workers > 1:
+        # Workers open their own connections, nothing opened here may be inherited across the fork
+        repository.close()
+        inboxes = [multiprocessing.Queue() for _ in range(args.workers)]
+        invalidations = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=run_worker, args=(index, args, inboxes[index], invalidations), name=f"worker-{index}") for index in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        relay = threading.Thread(target=relay_invalidations, args=(invalidations, inboxes))
+        relay.start()
+        bot = ShardRouter(args.token, inboxes, base_url=args.api_base_url)
+    else:
+        bot = build_bot(args, repository, metrics_port=args.metrics_port)
+    if args.mode == "webhook":
+        bot.start_webhook(args.webhook_listen, args.webhook_port, args.webhook_path, args.webhook_url, args.webhook_secret)
+    else:
+        bot.start()
+    if args.workers > 1:
+        for worker in workers:
+            worker.join()
+        # The relay has to be done with the queue before the interpreter tears it down
+        invalidations.put(None)
+        relay.join()
\ No newline at end of file